@@ -1,6 +1,7 @@
-from lark import Lark
 from lark import Transformer
 
+import larkcache
+
 grammar = r"""
 
 ?start: ((_NL+)? line _NL+)*
@@ -31,39 +32,42 @@ COMMAND: /.+/
 %ignore " "
 """
 
-parser = Lark(grammar, parser="lalr", start="start")
+parser = larkcache.build_parser("abcparser", grammar)
 
-result = []
-options = {}
-start = 0
 note_relation = {'G,': 60, 'A,': 61, 'B,': 62, 'C': 63, 'D': 64, 'E': 65, 'F': 66, 
                  'G': 67, 'A': 68, 'B': 69, 'c': 70, 'd': 71, 'e': 72, 'f': 73, 
                  'g': 74, 'a': 75, 'b': 76, 'c\'': 77, 'd\'': 78}
 
 class TreeTransformer(Transformer):
+    """Collects the notes and options of one ABC file, along 
+    with the start of the next note"""
+
+    def __init__(self):
+        super().__init__()
+        self.result = []
+        self.options = {}
+        self.next_start = 0
 
     def note(self, items):
         print(items)
-        global start
         note = items[0].value
         note += get_note_mods(items)
         note = get_related_note(note)
-        obj = get_start_and_duration(note)
-        result.append(obj)
+        obj = self.get_start_and_duration(note)
+        self.result.append(obj)
 
     def headerline(self, items):
         if items[0].value == 'Q':
-            options['bpm'] = int(items[2].value.split('=')[1])
+            self.options['bpm'] = int(items[2].value.split('=')[1])
         else:
             print(items[2].value)
 
-def get_start_and_duration(note):
-    global start
-    #TODO: dev
-    duration = 1
-    result = [note, start, duration]
-    start += duration
-    return result
+    def get_start_and_duration(self, note):
+        #TODO: dev
+        duration = 1
+        result = [note, self.next_start, duration]
+        self.next_start += duration
+        return result
 
 def get_note_mods(items):
     try:
@@ -101,10 +105,12 @@ def parse_file(filename):
         file_content = file_content + '\n'
     
     tree = parser.parse(file_content)
-    TreeTransformer().transform(tree)
+    transformer = TreeTransformer()
+    transformer.transform(tree)
+    return transformer.result, transformer.options
 
 def main():
-    parse_file('songs/abc/orange_in_bloom.abc')
+    result, options = parse_file('songs/abc/orange_in_bloom.abc')
     print(result) 
     print(options)
     return result, options
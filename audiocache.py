@@ -0,0 +1,500 @@
+'''Audio cache and in-memory clip bank used by the audio events'''
+import atexit
+import audioop
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import wave
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import partial
+from pathlib import Path
+
+import mixer
+
+memory_budget = 512 * 1024 * 1024
+variant_memory_budget = 256 * 1024 * 1024
+pitch_range = 0
+disk_quota = 2048 * 1024 * 1024
+chunk_frames = 65536
+workers = None
+pool = None
+
+cache_directory = 'audio/cache'
+manifest = None
+manifest_lock = threading.Lock()
+session_keys = set()
+
+clips = {"clips": OrderedDict(), "size": 0}
+variants = {"clips": OrderedDict(), "size": 0}
+variant_filenames = {}
+clips_lock = threading.Lock()
+
+Path(cache_directory).mkdir(parents=True, exist_ok=True)
+
+def get_audio_settings(audio):
+	"""Gets \"start\", \"end\" and \"volume\" values 
+	for an audio event or sets them to 0 by default."""
+	try:
+		start = audio['start']
+	except:
+		start = 0
+	try:
+		end = audio['end']
+	except:
+		end = 0
+	try:
+		volume = audio['volume']
+	except:
+		volume = 0
+	return start, end, volume
+
+def hash_source(filename):
+	"""Returns the sha256 of the contents of a source file"""
+	digest = hashlib.sha256()
+	with open(filename, 'rb') as f:
+		for chunk in iter(partial(f.read, 1024 * 1024), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def get_output_format():
+	"""Returns the sample rate, number of channels and sample width 
+	of the mixer, which every clip is converted to"""
+	return mixer.sample_rate, mixer.channels, mixer.sample_width
+
+def get_wav_format(filename):
+	with wave.open(filename, 'rb') as w:
+		return w.getframerate(), w.getnchannels(), w.getsampwidth()
+
+def get_gain(filename, start, end, volume):
+	"""Returns the factor the frames of a source are multiplied by.
+	Wav files without settings are only converted to the output format,
+	so they keep the level they have when they are played directly."""
+	extension = filename.lower().rsplit('.', 1)[1]
+	if extension == "wav" and start == 0 and end == 0 and volume == 0:
+		return 1
+	return 10 ** ((volume - 20) / 20)
+
+def get_cache_key(source_hash, start, end, volume, gain, output_format, semitones=0):
+	"""Returns the key of a cache entry, made from the contents of
+	the source and every parameter used to process it"""
+	values = [source_hash, start, end, volume, gain, list(output_format)]
+	if semitones != 0:
+		values.append(semitones)
+	return hashlib.sha256(json.dumps(values).encode('utf-8')).hexdigest()[:32]
+
+def get_cache_filename(key):
+	return cache_directory + '/' + key + '.wav'
+
+def needs_cache(filename, start, end, volume, output_format):
+	"""Checks if an audio file has to be converted before it can be played"""
+	extension = filename.lower().rsplit('.', 1)[1]
+	if extension != "wav" or start != 0 or end != 0 or volume != 0:
+		return True
+	try:
+		return get_wav_format(filename) != output_format
+	except (OSError, EOFError, wave.Error):
+		return True
+
+def is_valid_cache_file(filename, size=None):
+	"""Checks that a cache file exists, has the size recorded in the 
+	manifest and holds every frame its header announces, 
+	so stale or partial files are never played"""
+	try:
+		file_size = os.path.getsize(filename)
+		with wave.open(filename, 'rb') as w:
+			expected = w.getnframes() * w.getnchannels() * w.getsampwidth()
+	except (OSError, EOFError, wave.Error):
+		return False
+	if size is not None and file_size != size:
+		return False
+	return file_size >= expected + 44
+
+def build_audio_cache(filename, start, end, volume, output_format, source_hash=None, size=None, semitones=0):
+	"""Creates the cache file of an audio event, or of one of its 
+	pitch-shifted variants, if there isn't a valid one.
+	Runs inside the worker processes of the audio pool.
+	Returns the source's hash, the entry's key and the peak memory 
+	used while creating the file, or None if it already existed."""
+	if source_hash is None:
+		source_hash = hash_source(filename)
+	gain = get_gain(filename, start, end, volume)
+	key = get_cache_key(source_hash, start, end, volume, gain, output_format, semitones)
+	cache_filename = get_cache_filename(key)
+	if is_valid_cache_file(cache_filename, size):
+		return source_hash, key, None
+	tracing = tracemalloc.is_tracing()
+	if not tracing:
+		tracemalloc.start()
+	tracemalloc.reset_peak()
+	memory = {}
+	try:
+		write_cache_file(filename, cache_filename + '.tmp', start, end, gain, output_format, memory, semitones)
+		memory['python'] = tracemalloc.get_traced_memory()[1]
+	finally:
+		if not tracing:
+			tracemalloc.stop()
+	os.replace(cache_filename + '.tmp', cache_filename)
+	return source_hash, key, memory
+
+def get_trim(start, end):
+	"""Returns the offset in seconds of the first frame an audio event
+	plays and its duration, which is None when it plays until the end"""
+	offset = start if start > 0 else 0
+	duration = end - offset if end > 0 and end > start else None
+	return offset, duration
+
+def read_wav(filename, offset, duration):
+	"""Opens a wav source at the offset. Returns its sample rate, number 
+	of channels and sample width, along with a generator of its frames."""
+	w = wave.open(filename, 'rb')
+	rate = w.getframerate()
+	first = min(int(offset * rate), w.getnframes())
+	count = w.getnframes() - first
+	if duration is not None:
+		count = min(count, int(duration * rate))
+	w.setpos(first)
+	return (rate, w.getnchannels(), w.getsampwidth()), read_wav_chunks(w, count)
+
+def read_wav_chunks(w, count):
+	with w:
+		while count > 0:
+			data = w.readframes(min(count, chunk_frames))
+			if not data:
+				break
+			count -= len(data) // (w.getnchannels() * w.getsampwidth())
+			yield data
+
+def get_pitch_filter(semitones, rate):
+	"""Returns the ffmpeg filters that shift the pitch of a stream by
+	a number of semitones without changing its duration. The stream
+	is played faster or slower and its tempo is then restored."""
+	factor = 2 ** (semitones / 12)
+	filters = ['aresample=' + str(rate), 'asetrate=' + str(round(rate * factor)), 'aresample=' + str(rate)]
+	tempo = 1 / factor
+	# atempo only accepts tempos between 0.5 and 2
+	while tempo < 0.5:
+		filters.append('atempo=0.5')
+		tempo /= 0.5
+	while tempo > 2:
+		filters.append('atempo=2')
+		tempo /= 2
+	filters.append('atempo=' + str(round(tempo, 6)))
+	return ','.join(filters)
+
+def decode_source(filename, offset, duration, output_format, memory, semitones=0):
+	"""Starts decoding a source with ffmpeg, which seeks to the offset
+	instead of decoding the frames before it and converts the frames
+	to the sample rate and number of channels of the output format. 
+	Returns the format of the decoded frames, along with a generator 
+	of the frames."""
+	rate, channels = output_format[:2]
+	command = ['ffmpeg', '-v', 'error', '-nostdin']
+	if offset > 0:
+		command += ['-ss', str(offset)]
+	command += ['-i', filename]
+	if duration is not None:
+		command += ['-t', str(duration)]
+	if semitones != 0:
+		command += ['-af', get_pitch_filter(semitones, rate)]
+	command += ['-vn', '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', str(channels), '-ar', str(rate), '-']
+	process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	return (rate, channels, 2), read_process_chunks(process, channels * 2, filename, memory)
+
+def read_process_chunks(process, frame_size, filename, memory):
+	try:
+		while True:
+			data = process.stdout.read(chunk_frames * frame_size)
+			if not data:
+				break
+			yield data
+	finally:
+		process.stdout.close()
+		if hasattr(os, 'wait4'):
+			status, usage = os.wait4(process.pid, 0)[1:]
+			process.returncode = os.waitstatus_to_exitcode(status)
+			# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+			memory['decoder'] = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+		else:
+			process.wait()
+	if process.returncode != 0:
+		raise RuntimeError('ffmpeg could not decode ' + filename)
+
+def convert_chunks(chunks, source_format, output_format):
+	"""Converts chunks of frames to the output format, keeping the
+	state of the resampler from one chunk to the next"""
+	source_rate, source_channels, source_width = source_format
+	rate, channels, width = output_format
+	state = None
+	for data in chunks:
+		if source_width == 1:
+			# 8 bit wav files are unsigned
+			data = audioop.bias(data, 1, -128)
+		if source_width != width:
+			data = audioop.lin2lin(data, source_width, width)
+		if source_channels == 1 and channels == 2:
+			data = audioop.tostereo(data, width, 1, 1)
+		elif source_channels == 2 and channels == 1:
+			data = audioop.tomono(data, width, 0.5, 0.5)
+		if source_rate != rate:
+			data, state = audioop.ratecv(data, width, channels, source_rate, rate, state)
+		yield data
+
+def write_cache_file(filename, cache_filename, start, end, gain, output_format, memory, semitones=0):
+	"""Writes the trimmed and amplified frames of a source to a wav file
+	in the output format, a chunk at a time, so long sources are never 
+	held in memory. Wav files with one or two channels are converted
+	here, every other source and every pitch shift goes through ffmpeg."""
+	offset, duration = get_trim(start, end)
+	try:
+		wav_format = get_wav_format(filename)
+	except (EOFError, wave.Error):
+		wav_format = None
+	if wav_format is not None and wav_format[1] in (1, 2) and semitones == 0:
+		source_format, chunks = read_wav(filename, offset, duration)
+	else:
+		source_format, chunks = decode_source(filename, offset, duration, output_format, memory, semitones)
+	rate, channels, width = output_format
+	with wave.open(cache_filename, 'wb') as w:
+		w.setnchannels(channels)
+		w.setsampwidth(width)
+		w.setframerate(rate)
+		for data in convert_chunks(chunks, source_format, output_format):
+			if gain != 1:
+				data = audioop.mul(data, width, gain)
+			w.writeframesraw(data)
+
+def format_memory(memory):
+	"""Describes the peak memory used while creating a cache file"""
+	text = 'peak memory ' + str(round(memory['python'] / 1048576, 1)) + ' MB'
+	if 'decoder' in memory:
+		text += ', ffmpeg ' + str(round(memory['decoder'] / 1048576, 1)) + ' MB'
+	return text
+
+def load_manifest():
+	"""Reads the manifest of the cache, which lists every entry 
+	along with the hashes of the sources it has seen. 
+	Files left out of it by an earlier session are deleted."""
+	global manifest
+	if manifest is None:
+		try:
+			with open(cache_directory + '/manifest.json', encoding='utf-8') as f:
+				manifest = json.load(f)
+		except (OSError, ValueError):
+			manifest = {}
+		manifest.setdefault('sources', {})
+		manifest.setdefault('entries', {})
+		remove_orphan_files()
+	return manifest
+
+def remove_orphan_files():
+	"""Deletes the cache files that aren't in the manifest. Only runs 
+	when the manifest is first loaded, before any worker of this 
+	session writes a file, since a worker's file is only added to 
+	the manifest once the worker is done."""
+	for name in os.listdir(cache_directory):
+		if name.endswith('.wav') and name[:-4] not in manifest['entries']:
+			os.remove(cache_directory + '/' + name)
+
+def save_manifest():
+	with open(cache_directory + '/manifest.json.tmp', 'w', encoding='utf-8') as f:
+		json.dump(manifest, f)
+	os.replace(cache_directory + '/manifest.json.tmp', cache_directory + '/manifest.json')
+
+def get_known_entry(filename, start, end, volume, output_format, semitones=0):
+	"""Returns the hash of a source if it didn't change since it was last 
+	hashed, along with the recorded size of its cache file. The entry
+	is kept from eviction while a worker checks it."""
+	stat = os.stat(filename)
+	with manifest_lock:
+		load_manifest()
+		source = manifest['sources'].get(os.path.abspath(filename))
+		if source and source['mtime'] == stat.st_mtime_ns and source['size'] == stat.st_size:
+			key = get_cache_key(source['hash'], start, end, volume, get_gain(filename, start, end, volume), output_format, semitones)
+			entry = manifest['entries'].get(key)
+			if entry:
+				session_keys.add(key)
+			return source['hash'], entry['size'] if entry else None
+	return None, None
+
+def record_cache_entry(filename, source_hash, key):
+	"""Adds a used entry to the manifest and evicts the least recently 
+	used entries if the cache went over its disk quota"""
+	stat = os.stat(filename)
+	cache_filename = get_cache_filename(key)
+	with manifest_lock:
+		load_manifest()
+		manifest['sources'][os.path.abspath(filename)] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'hash': source_hash}
+		manifest['entries'][key] = {'source': os.path.abspath(filename), 'size': os.path.getsize(cache_filename), 'last_used': time.time()}
+		session_keys.add(key)
+		evict_cache_entries()
+		save_manifest()
+
+def evict_cache_entries():
+	"""Deletes the least recently used entries until the cache fits its 
+	quota. Entries used since the program started are never evicted."""
+	entries = manifest['entries']
+	for key in list(entries):
+		if not os.path.isfile(get_cache_filename(key)):
+			del entries[key]
+	total = sum(entry['size'] for entry in entries.values())
+	for key in sorted(entries, key=lambda key: entries[key]['last_used']):
+		if total <= disk_quota:
+			break
+		if key in session_keys:
+			continue
+		total -= entries[key]['size']
+		os.remove(get_cache_filename(key))
+		del entries[key]
+
+def get_pool():
+	global pool
+	if pool is None:
+		from concurrent.futures import ProcessPoolExecutor
+		pool = ProcessPoolExecutor(max_workers=workers)
+		atexit.register(pool.shutdown, cancel_futures=True)
+	return pool
+
+def prepare_audio_caches(audios, on_ready, on_done=None):
+	"""Prepares the cache of several audio events in a pool of processes.
+	Returns right away; on_ready is called with the index of each event 
+	and its playable version once its cache file is created and loaded. 
+	on_done is called with the seconds taken once every event finished."""
+	progress = {"done": 0, "total": len(audios), "submitted": False, 
+				"start": time.perf_counter(), "on_done": on_done}
+	output_format = get_output_format()
+	for i, audio in enumerate(audios):
+		filename = audio['filename']
+		if not os.path.isfile(filename):
+			print('Audio file '+filename+' not found!')
+			with clips_lock:
+				progress["total"] -= 1
+			continue
+		start, end, volume = get_audio_settings(audio)
+		if not needs_cache(filename, start, end, volume, output_format):
+			future = Future()
+			future.set_result(None)
+		else:
+			future = get_pool().submit(build_audio_cache, filename, start, end, volume, output_format,
+				*get_known_entry(filename, start, end, volume, output_format))
+		future.add_done_callback(partial(finish_audio_cache, i, audio, output_format, progress, on_ready))
+	with clips_lock:
+		progress["submitted"] = True
+	check_audio_progress(progress)
+
+def check_audio_progress(progress):
+	"""Calls on_done the first time every event is finished"""
+	with clips_lock:
+		finished = progress["submitted"] and progress["done"] == progress["total"]
+		if finished:
+			progress["submitted"] = False
+	if finished and progress["on_done"] is not None:
+		progress["on_done"](time.perf_counter() - progress["start"])
+
+def finish_audio_cache(i, audio, output_format, progress, on_ready, future):
+	"""Records a finished cache file, loads it into the clip bank, 
+	activates its event and starts preparing its variants"""
+	filename = audio['filename']
+	with clips_lock:
+		progress["done"] += 1
+		count = '[' + str(progress["done"]) + '/' + str(progress["total"]) + '] '
+	try:
+		result = future.result()
+		memory = None
+		if result is None:
+			cache_filename = filename
+		else:
+			record_cache_entry(filename, result[0], result[1])
+			cache_filename = get_cache_filename(result[1])
+			memory = result[2]
+		get_clip(cache_filename)
+	except Exception:
+		print('Audio cache ' + count + 'failed for ' + filename + '!')
+	else:
+		if memory is not None:
+			print('Audio cache ' + count + cache_filename + ' created, ' + format_memory(memory) + '!')
+		else:
+			print('Audio cache ' + count + cache_filename + ' ready!')
+		on_ready(i, {'type': 'audio', 'filename': cache_filename})
+		prepare_variants(audio, cache_filename, output_format)
+	check_audio_progress(progress)
+
+def prepare_variants(audio, cache_filename, output_format):
+	"""Prepares the variants of an audio event shifted by every pitch
+	within the pitch range, in the pool after every pending event"""
+	filename = audio['filename']
+	start, end, volume = get_audio_settings(audio)
+	with clips_lock:
+		shifts = [semitones for semitones in range(-pitch_range, pitch_range + 1)
+			if semitones != 0 and (cache_filename, semitones) not in variant_filenames]
+	pending = {"count": len(shifts)}
+	for semitones in shifts:
+		future = get_pool().submit(build_audio_cache, filename, start, end, volume, output_format,
+			*get_known_entry(filename, start, end, volume, output_format, semitones), semitones)
+		future.add_done_callback(partial(finish_variant, filename, cache_filename, semitones, pending))
+
+def finish_variant(filename, cache_filename, semitones, pending, future):
+	"""Records a finished variant and loads it into the variant bank"""
+	try:
+		source_hash, key, memory = future.result()
+		record_cache_entry(filename, source_hash, key)
+		get_variant_clip(get_cache_filename(key))
+	except Exception:
+		print('Audio variant ' + '{:+d}'.format(semitones) + ' failed for ' + filename + '!')
+	else:
+		with clips_lock:
+			variant_filenames[(cache_filename, semitones)] = get_cache_filename(key)
+	with clips_lock:
+		pending["count"] -= 1
+		finished = pending["count"] == 0
+	if finished:
+		print('Audio variants of ' + cache_filename + ' ready!')
+
+def load_clip(filename):
+	"""Reads a wav file into a buffer in the mixer's format, 
+	which can be played without touching the disk again"""
+	with wave.open(filename, 'rb') as w:
+		data = w.readframes(w.getnframes())
+		clip = mixer.convert_clip(data, w.getnchannels(), w.getsampwidth(), w.getframerate())
+	return clip, len(clip)
+
+def get_clip(filename):
+	"""Returns the clip of a wav file from the clip bank"""
+	return get_banked_clip(clips, memory_budget, filename)
+
+def get_variant_clip(filename):
+	"""Returns the clip of a pitch-shifted variant from the variant 
+	bank, which has its own budget so variants never evict clips"""
+	return get_banked_clip(variants, variant_memory_budget, filename)
+
+def get_pitched_clip(filename, semitones):
+	"""Returns the clip of a wav file shifted by a number of semitones, 
+	or the clip itself if that variant isn't ready"""
+	variant_filename = variant_filenames.get((filename, semitones))
+	if variant_filename is None:
+		return get_clip(filename)
+	return get_variant_clip(variant_filename)
+
+def get_banked_clip(bank, budget, filename):
+	"""Returns the clip of a wav file from a bank. The file is 
+	only read if the clip isn't loaded yet or was evicted. 
+	The least recently used clips are evicted when the bank 
+	goes over its memory budget."""
+	with clips_lock:
+		if filename in bank["clips"]:
+			bank["clips"].move_to_end(filename)
+			return bank["clips"][filename][0]
+	clip, size = load_clip(filename)
+	with clips_lock:
+		if filename not in bank["clips"] and size <= budget:
+			while bank["clips"] and bank["size"] + size > budget:
+				evicted, (evicted_clip, evicted_size) = bank["clips"].popitem(last=False)
+				bank["size"] -= evicted_size
+			bank["clips"][filename] = (clip, size)
+			bank["size"] += size
+	return clip
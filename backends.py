@@ -0,0 +1,262 @@
+'''Synthesizer and audio backends. The "alsa" backend plays through
+fluidsynth and a sounddevice output stream. The "null" backend makes no sound and
+records every event it receives with a timestamp, so the keyboard
+can be measured on machines without a sound card.'''
+import heapq
+import itertools
+import threading
+import time
+from ctypes import c_int, c_short, c_void_p, create_string_buffer
+from types import SimpleNamespace
+
+try:
+	import fluidsynth
+except ImportError:
+	fluidsynth = None
+
+current = None
+events = []
+events_lock = threading.Lock()
+
+def log_event(kind, *values):
+	"""Adds an event to the log of the null backend"""
+	with events_lock:
+		events.append((time.monotonic_ns(), kind) + values)
+
+def load_backend(name):
+	"""Loads a backend by name and makes it the current one.
+	Returns its synthesizer, sequencer and audio classes."""
+	global current
+	if name == 'null':
+		current = SimpleNamespace(name=name, driver=None, Synth=NullSynth,
+			Sequencer=NullSequencer, Output=NullOutput)
+	else:
+		if fluidsynth is None:
+			raise ImportError("The " + name + " backend needs the FluidSynth library")
+		current = SimpleNamespace(name=name, driver=name, Synth=FluidsynthSynth,
+			Sequencer=FluidsynthSequencer, Output=open_sounddevice_output)
+	return current
+
+def open_sounddevice_output(rate, channels, block_size, callback):
+	"""Opens an output stream of 16 bit samples that asks the callback 
+	for the data of each block. sounddevice is only imported once the 
+	stream is opened."""
+	import sounddevice
+
+	def fill(outdata, frames, time, status):
+		outdata[:] = callback(frames)
+
+	stream = sounddevice.RawOutputStream(samplerate=rate, channels=channels, dtype='int16',
+		blocksize=block_size, callback=fill)
+	stream.start()
+	return stream
+
+def write_log(filename):
+	"""Writes the event log as tab separated values, with times
+	in nanoseconds since the first event"""
+	with events_lock:
+		logged = list(events)
+	origin = logged[0][0] if logged else 0
+	with open(filename, 'w', encoding='utf-8') as f:
+		for event in logged:
+			f.write('\t'.join(str(value) for value in (event[0] - origin,) + event[1:]) + '\n')
+
+if fluidsynth is not None:
+	fluid_sequencer_remove_events = fluidsynth.cfunc('fluid_sequencer_remove_events', None,
+		('seq', c_void_p, 1), ('source', c_short, 1), ('dest', c_short, 1), ('type', c_int, 1))
+	fluid_sequencer_unregister_client = fluidsynth.cfunc('fluid_sequencer_unregister_client', None,
+		('seq', c_void_p, 1), ('id', c_short, 1))
+
+	class FluidsynthSynth(fluidsynth.Synth):
+		"""fluidsynth's synthesizer, with a way to pull samples
+		without an audio driver or numpy"""
+
+		def write_s16(self, frames):
+			"""Synthesizes the given number of frames and returns them
+			as interleaved 16 bit stereo samples"""
+			buffer = create_string_buffer(frames * 4)
+			fluidsynth.fluid_synth_write_s16(self.synth, frames, buffer, 0, 2, buffer, 1, 2)
+			return buffer.raw
+
+	class FluidsynthSequencer(fluidsynth.Sequencer):
+		"""fluidsynth's sequencer, with the calls needed to cancel
+		the events of a single client"""
+
+		def __init__(self, *args, **kwargs):
+			super().__init__(*args, **kwargs)
+			self.callbacks = {}
+
+		def register_client(self, name, callback, data=None):
+			"""Registers a client, keeping its ctypes callback alive
+			only until the client is unregistered"""
+			client = super().register_client(name, callback, data)
+			self.callbacks[client] = self.client_callbacks.pop()
+			return client
+
+		def remove_events(self, source):
+			"""Removes every queued event sent by the source"""
+			if fluid_sequencer_remove_events is not None:
+				fluid_sequencer_remove_events(self.sequencer, source, -1, -1)
+
+		def unregister_client(self, client):
+			if fluid_sequencer_unregister_client is not None:
+				fluid_sequencer_unregister_client(self.sequencer, client)
+			self.callbacks.pop(client, None)
+
+class NullSynth:
+	"""Synthesizer that only records the calls it receives"""
+
+	def __init__(self, gain=0.2, samplerate=44100, channels=256, **kwargs):
+		self.soundfonts = []
+
+	def start(self, driver=None, device=None, midi_driver=None):
+		log_event('start', driver)
+
+	def delete(self):
+		log_event('delete')
+
+	def sfload(self, filename, update_midi_preset=0):
+		self.soundfonts.append(filename)
+		log_event('sfload', filename)
+		return len(self.soundfonts)
+
+	def program_select(self, chan, sfid, bank, preset):
+		log_event('program_select', chan, sfid, bank, preset)
+		return 0
+
+	def noteon(self, chan, key, vel):
+		log_event('noteon', chan, key, vel)
+		return 0
+
+	def noteoff(self, chan, key):
+		log_event('noteoff', chan, key)
+		return 0
+
+	def cc(self, chan, ctrl, val):
+		log_event('cc', chan, ctrl, val)
+		return 0
+
+	def write_s16(self, frames):
+		return bytes(frames * 4)
+
+class NullSequencer:
+	"""Sequencer with the same interface as fluidsynth's. Events are
+	delivered by a timer thread at their time, either to a registered
+	synthesizer or to a client's callback."""
+
+	def __init__(self, time_scale=1000, use_system_timer=True):
+		self.origin = time.monotonic()
+		self.time_scale = time_scale
+		self.queue = []
+		self.clients = {}
+		self.ids = itertools.count(1)
+		self.order = itertools.count()
+		self.condition = threading.Condition()
+		self.running = True
+		if use_system_timer:
+			threading.Thread(target=self.run, daemon=True).start()
+
+	def register_fluidsynth(self, synth):
+		client = next(self.ids)
+		self.clients[client] = synth
+		return client
+
+	def register_client(self, name, callback, data=None):
+		client = next(self.ids)
+		self.clients[client] = callback
+		return client
+
+	def unregister_client(self, client):
+		with self.condition:
+			self.clients.pop(client, None)
+
+	def note_on(self, time, channel, key, velocity=127, source=-1, dest=-1, absolute=True):
+		self.schedule(time, absolute, ('noteon', channel, key, velocity), source, dest)
+
+	def note_off(self, time, channel, key, source=-1, dest=-1, absolute=True):
+		self.schedule(time, absolute, ('noteoff', channel, key), source, dest)
+
+	def timer(self, time, data=None, source=-1, dest=-1, absolute=True):
+		self.schedule(time, absolute, ('timer', data), source, dest)
+
+	def schedule(self, time, absolute, event, source, dest):
+		if not absolute:
+			time += self.get_tick()
+		log_event('schedule', time, source, dest, *event)
+		with self.condition:
+			heapq.heappush(self.queue, (time, next(self.order), event, source, dest))
+			self.condition.notify()
+
+	def remove_events(self, source):
+		with self.condition:
+			self.queue = [entry for entry in self.queue if entry[3] != source]
+			heapq.heapify(self.queue)
+		log_event('remove_events', source)
+
+	def get_tick(self):
+		return int((time.monotonic() - self.origin) * self.time_scale)
+
+	def process(self, msec):
+		"""Delivers every event due up to the given tick"""
+		while True:
+			with self.condition:
+				if not self.queue or self.queue[0][0] > msec:
+					return
+				entry = heapq.heappop(self.queue)
+			self.deliver(entry)
+
+	def run(self):
+		while self.running:
+			with self.condition:
+				if self.queue:
+					delay = (self.queue[0][0] - self.get_tick()) / self.time_scale
+				else:
+					delay = None
+				if delay is None or delay > 0:
+					self.condition.wait(delay)
+					continue
+				entry = heapq.heappop(self.queue)
+			self.deliver(entry)
+
+	def deliver(self, entry):
+		time, order, event, source, dest = entry
+		client = self.clients.get(dest)
+		if client is None:
+			return
+		if event[0] == 'timer':
+			client(time, None, self, event[1])
+		elif event[0] == 'noteon':
+			client.noteon(event[1], event[2], event[3])
+		else:
+			client.noteoff(event[1], event[2])
+
+	def delete(self):
+		with self.condition:
+			self.running = False
+			self.queue = []
+			self.condition.notify()
+
+class NullOutput:
+	"""Output stream that asks the callback for a block of audio at the 
+	pace of a sound card and discards it"""
+
+	def __init__(self, rate, channels, block_size, callback):
+		self.rate = rate
+		self.block_size = block_size
+		self.callback = callback
+		self.blocks = 0
+		self.running = True
+		threading.Thread(target=self.run, daemon=True).start()
+
+	def run(self):
+		due = time.monotonic()
+		while self.running:
+			self.callback(self.block_size)
+			self.blocks += 1
+			due += self.block_size / self.rate
+			delay = due - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+
+	def close(self):
+		self.running = False
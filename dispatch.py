@@ -0,0 +1,88 @@
+'''Compiles the parsed keybinds into a flat dispatch table, so that
+a key press only needs one dictionary lookup and one call'''
+import time
+
+import scheduler
+
+modifiers = ['alt', 'alt_r', 'ctrl', 'ctrl_r']
+
+def get_canonical_keys(keys, shift_keys):
+	"""Groups every key with its upper and lower case versions and
+	with the key it shares with shift. Returns a dictionary that maps
+	each key to the key representing its group, which is how held
+	keys are tracked."""
+	parents = {}
+
+	def find(key):
+		while parents.setdefault(key, key) != key:
+			parents[key] = parents[parents[key]]
+			key = parents[key]
+		return key
+
+	def union(a, b):
+		a = find(a)
+		b = find(b)
+		if a != b:
+			parents[max(a, b)] = min(a, b)
+
+	for key in keys:
+		union(key, key.upper())
+		union(key, key.lower())
+		if key in shift_keys:
+			union(key, shift_keys[key])
+	return {key: find(key) for key in parents}
+
+def compile_keybinds(key_dict, shift_keys, pitch, handlers):
+	"""Builds the dispatch table from the keybinds of every modifier.
+	Each (modifier, key) pair maps to a handler, its argument and the
+	canonical version of the key. Handlers are called with those two
+	values and the start time of the key event. Notes and chords are
+	converted with the given pitch ahead of time, so the table has to
+	be compiled again when the pitch changes."""
+	keys = set()
+	for mod in key_dict:
+		keys.update(key_dict[mod])
+	canonical_keys = get_canonical_keys(keys, shift_keys)
+	table = {}
+	for mod in key_dict:
+		for key, value in key_dict[mod].items():
+			if type(value) == int:
+				entry = (handlers['note'], scheduler.convert_into_final_note(value, pitch))
+			elif type(value) == list:
+				entry = (handlers['chord'], tuple(scheduler.convert_into_final_note(note, pitch) for note in value))
+			else:
+				entry = (handlers['event'], value)
+			table[(mod, key)] = entry + (canonical_keys[key],)
+	return table, canonical_keys
+
+def benchmark(keybinds='keybinds/keybinds.txt', presses=200000):
+	"""Measures the time spent by Python on each key press,
+	from the table lookup to the handler call"""
+	import json
+	import keyboardparser
+	data = keyboardparser.pre_parse_file(keybinds)
+	key_dict = {mod: data[mod] for mod in data if mod != 'config'}
+	with open('keybinds/shiftkeys.json') as f:
+		shift_keys = json.load(f)
+	counter = [0]
+
+	def handler(arg, canonical, start):
+		counter[0] += 1
+		return True
+
+	start = time.perf_counter()
+	table, canonical_keys = compile_keybinds(key_dict, shift_keys, 0, {'note': handler, 'chord': handler, 'event': handler})
+	compile_time = time.perf_counter() - start
+	keys = [key for key in table]
+	pressed_keys = {}
+	start = time.perf_counter_ns()
+	for i in range(presses):
+		entry = table.get(keys[i % len(keys)])
+		if entry is not None and entry[2] not in pressed_keys:
+			entry[0](entry[1], entry[2], i)
+	elapsed = time.perf_counter_ns() - start
+	print('Compiled ' + str(len(table)) + ' bindings in ' + str(round(compile_time * 1000, 3)) + ' ms')
+	print('Dispatched ' + str(presses) + ' presses, ' + str(round(elapsed / presses)) + ' ns per press')
+
+if __name__ == '__main__':
+	benchmark()
@@ -2,43 +2,72 @@
 '''KBE is an experimental music keyboard'''
 __version__ = "0.1"
 
+import time
+# Taken before the other imports so the startup report includes them
+startup_start = time.perf_counter()
+
 import _thread
 import argparse
+import atexit
 import json
 import os.path
+import queue
 import subprocess
 import sys
-import time
+from collections import deque
 from datetime import datetime
 from functools import partial
-from pathlib import Path
-from tkinter import *
-
-import fluidsynth
-import simpleaudio
-from PIL import Image, ImageTk
-from pydub import AudioSegment
-from pynput.keyboard import Key, Listener
 
+import audiocache
+import backends
+import dispatch
 import keyboardparser
+import keytrace
+import larkcache
+import latency
+import mixer
+import scheduler
 import songparser
 
+startup_times = {'imports': time.perf_counter() - startup_start}
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-k', '--keyboard', help='Changes the file used for the keybinds')
 parser.add_argument('-s', '--soundfont', help='Changes the soundfont that will be loaded')
 parser.add_argument('-t', '--terminal', action='store_true', help='Launches the program without the interface')
+parser.add_argument('-m', '--audio-memory', type=int, help='Changes the memory budget of the audio clip bank, in MB')
+parser.add_argument('-w', '--audio-workers', type=int, help='Changes the number of processes used to prepare the audio cache')
+parser.add_argument('-q', '--audio-cache-size', type=int, help='Changes the disk quota of the audio cache, in MB')
+parser.add_argument('--audio-rate', type=int, help='Changes the sample rate of the audio output, which audio files are converted to when cached')
+parser.add_argument('--audio-pitch-range', type=int, help='Prepares versions of the audio files shifted by up to this many semitones, played when the pitch changes')
+parser.add_argument('-l', '--latency-report', help='Writes the latency of every event type to a JSON file on exit')
+parser.add_argument('-b', '--backend', choices=['alsa', 'null'], default='alsa', help='Changes the synthesizer and audio backend, null plays no sound')
+parser.add_argument('--backend-log', help='Writes every event received by the null backend to a file on exit')
+parser.add_argument('--benchmark', action='store_true', help='Triggers every song and metronome binding instead of listening to the keyboard')
+parser.add_argument('--record-trace', help='Writes every key press and release to a trace file on exit')
+parser.add_argument('--replay-trace', help='Plays a trace file into the keyboard instead of listening to it')
+parser.add_argument('--startup-report', action='store_true', help='Prints the time spent on each step of the startup')
+parser.add_argument('--replay-speed', type=float, default=1.0, help='Speed of the replayed trace, 0 plays it as fast as possible')
 
 pitch = 0
 preset = 0
 volume = 100
 muted = False
 keybinds = ""
+keybinds_generation = 0
+latency_report = ""
 soundfont = "/usr/share/sounds/sf2/FluidR3_GM.sf2"
 terminal = False
+benchmark = False
+replay_trace = ""
+replay_speed = 1.0
+startup_report = False
 
 key_dict = {}
 shift_keys = {}
 pressed_keys = {}
+dispatch_table = {}
+canonical_keys = {}
 background_audio = {}
 background_songs = {}
 active_events = {}
@@ -49,50 +78,80 @@ recording_mode = ""
 recording_start = 0
 is_recording = False
 metronome_on = False
+metronome = None
 first_recording = True
 recording_mod = None
 recording_key = None
 recording_filename = ""
 awaiting_record_button = False
 
-alt_pressed = False
-ctrl_pressed = False
-alt_r_pressed = False
-ctrl_r_pressed = False
+held_modifiers = {'alt': False, 'alt_r': False, 'ctrl': False, 'ctrl_r': False}
+current_mod = 'normal'
+
+event_queue = queue.SimpleQueue()
+gui_updates = deque()
+gui_interval = 15
 
 songs = []
 presets = {}
-sequencers = {}
+soundfonts = {}
+engine = []
+engine_lock = _thread.allocate_lock()
+keyboard_channel = 0
+metronome_channel = 1
+drum_channel = 9
+next_channel = 2
 keys_to_buttons = {}
+icons = {}
+icon_size = 30
+icon_cache_directory = 'icons/cache'
+
+def start_engine():
+	"""Starts the synthesizer and the sequencer that are shared 
+	by the keyboard, the metronome and every song"""
+	fs = backends.current.Synth()
+	fs.start(driver=backends.current.driver)
+	seq = backends.current.Sequencer()
+	synthID = seq.register_fluidsynth(fs)
+	engine[:] = [fs, seq, synthID]
+	update_master_gain()
 
-Path("audio/cache").mkdir(parents=True, exist_ok=True)
+def load_soundfont(sf):
+	"""Loads a soundfont into the synthesizer the first time it is used"""
+	if sf not in soundfonts:
+		start = time.perf_counter()
+		soundfonts[sf] = engine[0].sfload(sf)
+		record_startup('soundfonts', start)
+	return soundfonts[sf]
 
 def start_sequencer():
-	"""Starts the synthesizer and sequencer on program start"""
+	"""Selects the default soundfont and preset on the keyboard's channel"""
 	global soundfont
-	fs = fluidsynth.Synth()
-	fs.start(driver='alsa')
-	sfid = fs.sfload(soundfont)
-	fs.program_select(0, sfid, 0, preset)
-	seq = fluidsynth.Sequencer()
-	synthID = seq.register_fluidsynth(fs)
-	sequencers[0] = [fs, seq, synthID, sfid]
+	sfid = load_soundfont(soundfont)
+	engine[0].program_select(keyboard_channel, sfid, 0, preset)
 
 def setup_metronome():
-	"""Creates and registers the metronome sequencer"""
-	fs = fluidsynth.Synth()
-	fs.start(driver='alsa')
-	sfid = fs.sfload("./soundfonts/percussion2.sf2")
-	fs.program_select(0, sfid, 0, 0)
-	seq = fluidsynth.Sequencer()
-	synthID = seq.register_fluidsynth(fs)
-	sequencers[1] = [fs, seq, synthID, sfid]
-
-def restart_sequencer(sf, preset):
-	"""Restarts the sequencer and registers a new synthesizer ID"""
-	presets[sf][preset][1].delete()
-	presets[sf][preset][1] = fluidsynth.Sequencer()
-	presets[sf][preset][2] = presets[sf][preset][1].register_fluidsynth(presets[sf][preset][0])
+	"""Selects the metronome's soundfont on its own channel"""
+	sfid = load_soundfont("./soundfonts/percussion2.sf2")
+	engine[0].program_select(metronome_channel, sfid, 0, 0)
+
+def get_preset_channel(preset, sf):
+	"""Returns the channel used for a preset of a soundfont.
+	Channels are assigned the first time a preset is used."""
+	global next_channel
+	with engine_lock:
+		if sf in presets and preset in presets[sf]:
+			return presets[sf][preset]
+		if next_channel == drum_channel:
+			next_channel += 1
+		channel = next_channel
+		next_channel += 1
+		engine[0].program_select(channel, load_soundfont(sf), 0, preset)
+		if sf in presets:
+			presets[sf][preset] = channel
+		else:
+			presets[sf] = {preset: channel}
+		return channel
 
 def get_file_ending(filename):
 	"""Returns the file ending of the filename given as input"""
@@ -108,8 +167,11 @@ def set_shiftkeys():
 def set_keybinds():
 	"""Gets and sets the keybinds from the keybinds file.
 	Checks the file's ending and sets keybinds for every modifier."""
-	global soundfont, preset, songs, volume, pitch
+	global soundfont, preset, songs, volume, pitch, keybinds_generation
 	data = keyboardparser.pre_parse_file(keybinds)
+	keybinds_generation += 1
+	audios = []
+	song_files = []
 	for mod in data.keys():
 		if mod == 'config':
 			for key, value in data.get(mod).items():
@@ -119,6 +181,7 @@ def set_keybinds():
 					soundfont = value
 				if key == 'volume':
 					volume = value
+					update_master_gain()
 				if key == 'pitch':
 					pitch = value
 		else:
@@ -131,14 +194,68 @@ def set_keybinds():
 						if value.get('mode') == None:
 							value['mode'] = 'replace'
 					elif value['type'] == 'audio':
-						value = prepare_audio_cache(value)
+						audios.append((mod, key, value))
+						continue
 					elif value['type'] == 'song':
 						if os.path.isfile(value['filename']):
 							songs.append(value['filename'])
+							song_files.append(value['filename'])
 						else:
 							print('Song file '+value['filename']+' not found!')
 					if value:
 						key_dict[mod][key] = value
+	prepare_song_caches(song_files)
+	compile_dispatch_table()
+	audiocache.prepare_audio_caches([audio[2] for audio in audios], 
+		partial(activate_audio_binding, keybinds_generation, audios), finish_audio_startup)
+
+def activate_audio_binding(generation, audios, i, value):
+	"""Binds an audio event to its key once its cache is ready, 
+	unless the keybinds were replaced in the meantime"""
+	if generation == keybinds_generation:
+		mod, key = audios[i][0], audios[i][1]
+		key_dict[mod][key] = value
+		compile_dispatch_table()
+
+def finish_audio_startup(elapsed):
+	"""Called once every audio cache of the keybinds is ready"""
+	if 'audio cache' not in startup_times:
+		startup_times['audio cache'] = elapsed
+		if startup_report:
+			print_startup_report()
+
+def record_startup(step, start):
+	"""Adds the time elapsed since start to a step of the startup. 
+	Steps are only recorded until the keyboard is ready."""
+	if 'first playable note' not in startup_times:
+		startup_times[step] = startup_times.get(step, 0) + time.perf_counter() - start
+
+def print_startup_report():
+	"""Prints the time spent on each step of the startup. The audio 
+	cache is prepared in the background, so it can finish after the 
+	keyboard is ready."""
+	print('Startup (ms)')
+	for step, elapsed in startup_times.items():
+		print('  ' + step.ljust(32) + str(round(elapsed * 1000, 1)).rjust(10))
+		if step == 'imports':
+			for name, (elapsed, action) in larkcache.timings.items():
+				print('    ' + (name + ' tables ' + action).ljust(30) + str(round(elapsed * 1000, 1)).rjust(10))
+	if 'audio cache' not in startup_times:
+		print('  audio cache'.ljust(34) + 'pending'.rjust(10))
+
+def compile_dispatch_table():
+	"""Compiles the keybinds into the table used by on_press. 
+	Called whenever the keybinds, shift keys or pitch change."""
+	global dispatch_table, canonical_keys
+	handlers = {'note': press_note, 'chord': press_chord, 'event': press_event}
+	dispatch_table, canonical_keys = dispatch.compile_keybinds(key_dict, shift_keys, pitch, handlers)
+
+def prepare_song_caches(filenames):
+	"""Parses the songs ahead of time, several at once, so that 
+	playing them later only needs a cache lookup"""
+	for filename, loaded in songparser.load_songs(filenames).items():
+		if isinstance(loaded, Exception):
+			print('Song file '+filename+' could not be parsed!')
 
 def swap_keybinds(new_keybinds):
 	"""Switches the current keybinds to the keybinds
@@ -176,39 +293,6 @@ def add_start(start, notes):
 			note["start"] += start
 	return notes
 
-def prepare_song(key, obj, start, note_list):
-	"""Attempts to get start and loop parameters from the song 
-	object before playing the song.
-	If values don't exist, sets preset values for them."""
-	loop = 1
-	pitch = 0
-	try:
-		if "start" in obj:
-			start += obj['start']
-	except:
-		pass
-	try:
-		if "loop" in obj:
-			loop = obj['loop']
-	except:
-		pass
-	try:
-		if "pitch" in obj:
-			pitch = obj['pitch']
-	except:
-		pass
-	filename = obj['filename']
-	total = play_song(key, filename, start, loop, pitch, note_list)
-	add_active_event(total, key, filename)
-	return total
-
-def get_preset_info(preset, sf):
-	fs = presets[sf][preset][0]
-	seq = presets[sf][preset][1]
-	synthID = presets[sf][preset][2]
-	sfid = presets[sf][preset][3]
-	return [fs, seq, synthID, sfid]
-
 #def play_song(key, filename, start, loop, pitch, note_list):
 #	"""Plays a given song. Checks the file ending to 
 #	define how the events in the song are extracted."""
@@ -285,81 +369,70 @@ def get_song_obj_data(obj):
 #				total = new_total
 #	return total
 
-def convert_start_end(start, end, bpm):
-	bpm = 60000/bpm
-	start *= bpm
-	end *= bpm
-	return int(start), int(end)
-	
-def set_song_notes(key, loop, total, notes, note_list, seq, pitch, synthID, bpm):
-	for i in range(0, loop):
-		start = total
-		for j in range(0, len(notes)):
-			note = notes[j]
-			if type(note) == dict:
-				if note['type'] == 'song':
-					new_total = prepare_song(key, note, start, notes)
-				elif note['type'] == 'pause':
-					start += note['value']
-			else:
-				if i == 0:
-					note_list.append(note)
-				try:
-					channel = note[3]
-				except:
-					channel = 0
-				try:
-					velocity = note[4]
-				except:
-					velocity = 100
-				if bpm != 0:
-					note_start, note_end = convert_start_end(note[1], note[2], bpm)
-				else:
-					note_start = int(note[1])
-					note_end = int(note[2])
-				if type(note) == list and type(note[0]) == list:
-					for n in note[0]:
-						final_note = convert_into_final_note(n, pitch)
-						seq.note_on(time=note_start + start, absolute=False, channel=channel, key=final_note, velocity=velocity, dest=synthID)
-						seq.note_off(time=note_start + note_end + start, absolute=False, channel=channel, key=final_note, dest=synthID)
-						new_total = note_start + note_end + start
-						if new_total > total:
-							total = new_total
-				elif type(note) == list and type(note[0]) == int:
-					final_note = convert_into_final_note(note[0], pitch)
-					seq.note_on(time=note_start + start, absolute=False, channel=channel, key=final_note, velocity=velocity, dest=synthID)
-					seq.note_off(time=note_start + note_end + start, absolute=False, channel=channel, key=final_note, dest=synthID)
-					new_total = note_start + note_end + start
-			if new_total > total:
-				total = new_total
-	return total
+def set_song_notes(key, filename, loop, origin, notes, pitch, channel, bpm, depth=0, on_end=None):
+	"""Starts streaming the notes of a song into the sequencer.
+	Only the events inside the look-ahead window are queued here, 
+	the scheduler adds the rest while the song is playing."""
+	[fs, seq, synthID] = engine
+	timeline, length = scheduler.get_timeline(filename, notes, bpm)
+	return scheduler.start_stream(seq, synthID, timeline, length, loop, pitch, origin, channel,
+		on_song=partial(play_nested_song, key), on_end=on_end, depth=depth)
+
+def start_song_stream(key, filename, delay, loop, pitch, depth=0, on_end=None):
+	"""Loads a song and starts streaming it after the given delay"""
+	notes, options = songparser.load_song(filename)
+	if not notes:
+		return None
+	preset, sf, bpm, signature = get_song_options(options)
+	channel = get_preset_channel(preset, sf)
+	return set_song_notes(key, filename, loop, engine[1].get_tick() + delay, notes, pitch, channel, bpm, depth, on_end)
 
 def play_song(key, obj):
-	note_list = []
 	start, loop, pitch, filename = get_song_obj_data(obj)
-	total = start
-
-	notes, options = songparser.pre_convert_song(filename)
-	if notes:
-		preset, sf, bpm, signature = get_song_options(options)
-		[fs, seq, synthID, sfid] = get_preset_info(preset, sf)
-		fs.program_select(0, sfid, 0, preset)
-		total = set_song_notes(key, loop, total, notes, note_list, seq, pitch, synthID, bpm)
-		seqID = seq.register_client("me", song_callback)
-		background_songs[key] = {"end_time": int(round(time.time() * 1000)) + total, "note_list": note_list, "preset": preset, "soundfont": sf}
-		total += seq.get_tick()
-		seq.timer(total, dest=seqID, data=key)
-		add_active_event(total, key, filename)
-
-def song_callback(time, event, seq, data):
-	if time in active_events:
-		active_events.pop(time)
-		refresh_active_events()
+	scheduled = latency.now()
+	stream = start_song_stream(key, filename, start, loop, pitch, on_end=partial(end_song_stream, key))
+	latency.record('schedule', scheduled)
+	if stream:
+		total = start + stream["loop"] * stream["length"]
+		background_songs[key] = {"end_time": int(round(time.time() * 1000)) + total, "stream": stream}
+		add_active_event(stream["end"], key, filename)
+
+def play_nested_song(key, parent, obj, tick):
+	"""Starts a song that is called from inside another song.
+	Called by the scheduler when the song's start enters the window."""
+	try:
+		start, loop, pitch, filename = get_song_obj_data(obj)
+		delay = tick - parent["seq"].get_tick()
+		return start_song_stream(key, filename, delay, loop, parent["pitch"] + pitch, parent["depth"] + 1,
+			on_end=partial(end_song_stream, key))
+	except Exception:
+		print('Song file '+obj.get('filename', '')+' could not be played!')
+
+def end_song_stream(key, stream):
+	"""Called from the sequencer once a stream played every event. 
+	The stream is cleaned up by the event worker, since a client 
+	can't be unregistered from inside its own callback."""
+	event_queue.put((finish_song_stream, (key, stream)))
+
+def finish_song_stream(key, stream):
+	"""Unregisters the client of a finished stream. Once every stream
+	of the song finished, the song stops being a background song."""
+	engine[1].unregister_client(stream["client"])
+	if stream["depth"] == 0:
+		song_callback(key, stream)
+	song = background_songs.get(key)
+	if song is not None and not any(s["active"] for s in scheduler.iter_streams(song["stream"])):
+		del background_songs[key]
+
+def song_callback(key, stream):
+	if stream["end"] in active_events and active_events[stream["end"]][0] == key:
+		active_events.pop(stream["end"])
+		update_gui(refresh_active_events)
 
 def add_active_event(total, key, filename):
 	text = key + ": " + filename + "\n"
 	active_events[total] = [key, text]
-	refresh_active_events()
+	update_gui(refresh_active_events)
 
 def refresh_active_events():
 	event_text.delete(1.0, END)
@@ -367,118 +440,60 @@ def refresh_active_events():
 	for key in active_events:
 		event_text.insert(END, active_events[key][1])
 
-def fetch_fluidsynth_info(key):
-	preset = background_songs[key]['preset']
-	sf = background_songs[key]['soundfont']
-	fs = presets[sf][preset][0]
-	note_list = background_songs[key]['note_list']
-	return [preset, sf, fs, note_list]
+def stop_song_streams(key):
+	"""Stops every stream started by a song, removes the events 
+	they still had queued and releases the notes that are sounding. 
+	Other songs keep playing."""
+	[fs, seq, synthID] = engine
+	scheduler.stop_stream(background_songs[key]['stream'])
+	for stream in scheduler.iter_streams(background_songs[key]['stream']):
+		seq.remove_events(stream['client'])
+		seq.unregister_client(stream['client'])
+		for channel, note in scheduler.get_sounding_keys(stream, seq.get_tick()):
+			fs.noteoff(channel, note)
 
 def stop():
 	"""Stops all songs that are currently playing in the background"""
 	global background_songs
 	for key in background_songs:
-		[preset, sf, fs, note_list] = fetch_fluidsynth_info(key)
-		try:
-			for note in note_list:
-				if type(note[0]) == int:
-					fs.noteoff(0, note[0])
-				elif type(note[0]) == list:
-					for n in note[0]:
-						fs.noteoff(0, n)
-		except:
-			pass
-		restart_sequencer(sf, preset)
+		stop_song_streams(key)
 	background_songs = {}
 
 def stop_song(key):
 	"""Stops one song playing in the background. 
 	The song is selected by the key given as argument"""
-	[preset, sf, fs, note_list] = fetch_fluidsynth_info(key)
-	try:
-		for note in note_list:
-			if type(note[0]) == int:
-				fs.noteoff(0, note[0])
-			elif type(note[0]) == list:
-				for n in note[0]:
-					fs.noteoff(0, n)
-	except:
-		pass
+	stop_song_streams(key)
 	del background_songs[key]
 	delete_active_event(key)
-	restart_sequencer(sf, preset)
 
 def delete_active_event(key):
 	global active_events
 	for time in active_events.keys():
 		if active_events[time][0] == key:
 			active_events.pop(time)
-			refresh_active_events()
+			update_gui(refresh_active_events)
 			return
 
-def prepare_audio_cache(audio):
-	"""Prepares the audio cache before the program starts 
-	to avoid delays in playing audio files. 
-	Gets \"start\", \"end\" and \"volume\" values 
-	for every file or sets them to 0 by default. 
-	New cache files are created if necessary and are saved in .wav format."""
-	filename = audio['filename']
-	try:
-		start = audio['start']
-	except:
-		start = 0
-	try:
-		end = audio['end']
-	except:
-		end = 0
-	try:
-		volume = audio['volume']
-	except:
-		volume = 0
-	extension = filename.lower().rsplit('.', 1)[1]
-	if not os.path.isfile(filename):
-		print('Audio file '+filename+' not found!')
-		return
-	if extension != "wav" or start != 0 or end != 0 or volume != 0:
-		old_filename = filename
-		values = '-' + str(start) + '-' + str(end) + '-' + str(volume)
-		filename = filename.rsplit('.', 1)[0]
-		filename = filename.rsplit('/', 1)[1]
-		filename = 'audio/cache/' + filename + values + '.wav'
-		if os.path.isfile(filename):
-			print('File \'' + filename + '\' loaded!')
-		else:
-			audio = AudioSegment.from_file(old_filename, format=extension) - 20 + volume
-			if end > 0 and end > start:
-				end = 1000 * end
-				audio = audio[:end]
-			if start > 0:
-				duration = audio.duration_seconds
-				start = duration - start
-				start = -1000 * start
-				audio = audio[start:]
-			audio.export(filename, format='wav')
-			print('File \'' + filename + '\' created!')
-	return {'type': 'audio', 'filename': filename}
-
 def start_background_audio(key, filename):
 	"""Starts the selected audio file in the background.
 	This function is called if a key is pressed and the 
-	related audio file is not currently playing."""
-	wave_obj = simpleaudio.WaveObject.from_wave_file(filename)
-	background_audio[key] = {'object': wave_obj.play(), 'filename': filename, 'playing': True}
+	related audio file is not currently playing. 
+	The clip is shifted by the current pitch if its 
+	variant was prepared."""
+	clip = audiocache.get_pitched_clip(filename, pitch)
+	background_audio[key] = {'voice': mixer.play(clip), 'filename': filename, 'playing': True}
 
 def stop_background_audio(key):
 	"""Stops an active background audio file.
 	This function is called if a key is pressed and the 
 	related audio file is currently playing."""
-	background_audio[key].get('object').stop()
+	mixer.stop(background_audio[key]['voice'])
 	background_audio[key]['playing'] = False 
 
 def await_record_button():
 	global awaiting_record_button
 	awaiting_record_button = True
-	show_await_recording_label()
+	update_gui(show_await_recording_label)
 
 def generate_recording_filename(key):
 	now = datetime.now()
@@ -506,6 +521,7 @@ def swap_event_with_song():
 	global recording_mod, recording_key, recording_filename
 	aux = {"type": "song", "filename": recording_filename}
 	key_dict[recording_mod][recording_key] = aux
+	compile_dispatch_table()
 
 def stop_recording():
 	"""Stops the current recording session. The filename
@@ -539,15 +555,18 @@ def add_pitch_to_event(event):
 		event = 0
 	return event
 
-def record_event(key, event):
-	"""Adds an event given as argument to the current recording session."""
+def record_event(key, event, now=None):
+	"""Adds an event given as argument to the current recording session.
+	The time of the key press can be given if it happened earlier."""
 	global recording_start, recording_filename, first_recording, pitch
 	if check_for_invalid_event(event):
 		return
+	if now is None:
+		now = int(round(time.time() * 1000))
 	if first_recording:
-		recording_start = int(round(time.time() * 1000))
+		recording_start = now
 		first_recording = False
-	event_start = int(round(time.time() * 1000)) - recording_start
+	event_start = now - recording_start
 	if type(event) == dict:
 		aux = event
 		aux['start'] = event_start
@@ -563,15 +582,17 @@ def record_event(key, event):
 		recording_aux[key]['event'] = event
 		recording_aux[key]['start'] = event_start
 
-def update_recording(key):
+def update_recording(key, now=None):
 	"""Inserts an event into the recording list."""
 	global recording_start
+	if now is None:
+		now = int(round(time.time() * 1000))
 	aux = recording_aux[key]
 	if type(aux['event']) == dict:
-		end_time = int(round(time.time() * 1000)) - recording_start - aux['event']['start']
+		end_time = now - recording_start - aux['event']['start']
 		recording.append(aux['event'])
 	else:
-		end_time = int(round(time.time() * 1000)) - recording_start - aux['start']
+		end_time = now - recording_start - aux['start']
 		new = []
 		new.append(aux['event'])
 		new.append(aux['start'])
@@ -594,99 +615,67 @@ def set_recording_destination(mod, key):
 		recording = []
 	elif recording_mode == 'append':
 		recording = songparser.pre_convert_song(recording_filename)
-	hide_await_recording_label()
+	update_gui(hide_await_recording_label)
 
-def start_metronome(aux):
-	"""Function that starts a metronome, with
-	the beat durations being calculated from the
-	BPM. If a time signature is given, two different notes
-	are used to set it."""
-	global metronome_on
-	metronome_on = True
-	seq = sequencers[1][1]
-	synthID = sequencers[1][2]
-	start = 0
+def get_metronome_settings(aux):
 	bpm = aux.get("bpm")
 	if "time" in aux:
 		time = aux.get("time")
 	else:
 		time = 1
-	duration = int(60000 / bpm)
-	
-	for i in range(0, 1000):
-		mod = i % time
-		if mod == 0:
-			key = 67
-		else:
-			key = 68
-		seq.note_on(time=start, absolute=False, channel=0, key=key, velocity=100, dest=synthID)
-		seq.note_off(time=start + duration, absolute=False, channel=0, key=key, dest=synthID)
-		start += duration
-	change_metronome_label_bpm(bpm)
+	return bpm, time
+
+def start_metronome(aux):
+	"""Function that starts a metronome, with
+	the beat durations being calculated from the
+	BPM. If a time signature is given, two different notes
+	are used to set it. Beats are queued a few bars ahead 
+	by the scheduler for as long as the metronome is on."""
+	global metronome_on, metronome
+	metronome_on = True
+	[fs, seq, synthID] = engine
+	bpm, time = get_metronome_settings(aux)
+	metronome = scheduler.start_metronome_stream(seq, synthID, bpm, time, metronome_channel)
+	update_gui(change_metronome_label_bpm, bpm)
+
+def change_metronome(aux):
+	"""Changes the tempo and time signature of the
+	metronome without stopping it"""
+	bpm, time = get_metronome_settings(aux)
+	scheduler.change_metronome_stream(metronome, bpm, time)
+	update_gui(change_metronome_label_bpm, bpm)
+
+def is_current_metronome(aux):
+	bpm, time = get_metronome_settings(aux)
+	return metronome["bpm"] == bpm and metronome["time"] == time
 
 def stop_metronome():
-	"""Deletes the metronome sequencer and
-	replaces it with a new one"""
+	"""Stops the metronome and removes its queued beats"""
 	global metronome_on
 	metronome_on = False
-	sequencers[1][1].delete()
-	sequencers[1][1] = fluidsynth.Sequencer()
-	sequencers[1][2] = sequencers[1][1].register_fluidsynth(sequencers[1][0])
-	change_metronome_label_off()
+	scheduler.stop_metronome_stream(metronome)
+	update_gui(change_metronome_label_off)
 
 def change_preset(new_preset):
 	"""Swaps the default preset being used 
 	by the keyboard"""
 	global preset
-	fs = sequencers[0][0]
-	sfid = sequencers[0][3]
+	fs = engine[0]
+	sfid = load_soundfont(soundfont)
 	if preset != new_preset:
 		preset = new_preset
-		fs.program_select(0, sfid, 0, new_preset)
+		fs.program_select(keyboard_channel, sfid, 0, new_preset)
 		print('Preset changed to: ' + str(new_preset))
 
-def add_pressed_keys(mod, key):
-	"""Adds a key into the list of keys that are 
-	currently being held."""
-	global pitch
-	try:
-		if key in key_dict.get(mod):
-			aux = key_dict.get(mod).get(key)
-			if type(aux) == int:
-				aux += pitch
-				if aux < 0:
-					aux = 0
-				elif aux > 127:
-					aux = 127
-			elif type(aux) == list:
-				new = []
-				for note in aux:
-					note += pitch
-					if note < 0:
-						note = 0
-					elif note > 127:
-						note = 127
-					new.append(note)
-				aux = new
-			pressed_keys[key] = {"pressed": True, "event": aux, "mod": mod}
-	except:
-		pass
-
-def convert_into_final_note(note, pitch):
-	final_note = note + pitch
-	if final_note < 0:
-		final_note = 0
-	elif final_note > 127:
-		final_note = 127
-	return final_note
-
-def play_note(note):
-	"""Plays a single note. The note ID is given as an argument."""
+def play_note(note, start=None):
+	"""Plays a single note. The note ID is given as an argument.
+	If the time of the key press is given its latency is recorded."""
 	global pitch, volume
-	fs = sequencers[0][0]
+	fs = engine[0]
 	converted_volume = int(volume * 1.27)
-	final_note = convert_into_final_note(note, pitch)
-	fs.noteon(0, final_note, converted_volume)
+	final_note = scheduler.convert_into_final_note(note, pitch)
+	fs.noteon(keyboard_channel, final_note, converted_volume)
+	latency.record('note', start)
 
 def change_pitch(change):
 	global pitch
@@ -695,7 +684,8 @@ def change_pitch(change):
 		pitch = 127
 	if pitch < -127:
 		pitch = -127
-	change_pitch_num_label()
+	compile_dispatch_table()
+	update_gui(change_pitch_num_label)
 	print('Current pitch shift: ' + str(pitch))
 
 def change_volume(change):
@@ -705,12 +695,24 @@ def change_volume(change):
 		volume = 0
 	elif volume > 100:
 		volume = 100
-	change_volume_num_label()
+	update_master_gain()
+	update_gui(change_volume_num_label)
 	print('Current volume: ' + str(volume))
 
-def play_event(mod, key):
+def update_master_gain():
+	"""Applies the volume to the audio events, which are silenced 
+	while the keyboard is muted"""
+	if muted:
+		mixer.set_master_gain(0)
+	else:
+		mixer.set_master_gain(volume / 100)
+
+def play_event(mod, key, played=False, now=None, start=None):
 	"""Receives a key for an event as argument and checks the type 
-	of the event to call the appropriate auxiliary function."""
+	of the event to call the appropriate auxiliary function.
+	Notes and chords that were already played by the listener 
+	are only recorded. If the time of the key press is given, 
+	the latency of the event is recorded."""
 	global is_recording, volume, muted, preset, recording_mode, awaiting_record_button
 	try:
 		if key in key_dict.get(mod):
@@ -723,59 +725,75 @@ def play_event(mod, key):
 			elif aux == "mute" and muted:
 				print("Keyboard unmuted!")
 				muted = False
-				change_volume_num_label()
+				update_master_gain()
+				update_gui(change_volume_num_label)
 			elif aux == "mute":
 				print("Keyboard muted!")
 				stop()
 				muted = True
-				show_muted_volume_icon()
+				update_master_gain()
+				update_gui(show_muted_volume_icon)
 			elif aux == "stop":
 				stop()
 			elif aux == "reload":
 				set_keybinds()
+			elif aux == "stats":
+				latency.dump()
+				if latency_report:
+					latency.export(latency_report)
 			if not muted:
 				if is_recording:
-					record_event(key, aux)
+					record_event(key, aux, now)
 				if awaiting_record_button:
 					set_recording_destination(mod, key)
+				elif played:
+					pass
 				elif type(aux) == int:
-					play_note(aux)
+					play_note(aux, start)
 				elif type(aux) == list:
 					for note in aux:
 						play_note(note)
+					latency.record('chord', start)
 				elif type(aux) == dict:
 					if aux.get('type') == 'song':
 						if key in background_songs and background_songs[key]["end_time"] > int(round(time.time() * 1000)):
 							stop_song(key)
 						else:
 							play_song(key, aux)
+							latency.record('song', start)
 							#prepare_song(key, aux, 0, [])
 					elif aux.get('type') == 'audio':
 						if key in background_audio:
-							if background_audio[key]['object'].is_playing() == False:
+							if not mixer.is_playing(background_audio[key]['voice']):
 								start_background_audio(key, background_audio[key]['filename'])
+								latency.record('audio', start)
 							else:
 								stop_background_audio(key)
 						else:
 							start_background_audio(key, aux['filename'])
+							latency.record('audio', start)
 					elif aux.get('type') == 'record' and not is_recording:
 						recording_mode = aux.get('mode')
 						#start_recording()
 						await_record_button()
-						show_recording_icon()
+						update_gui(show_recording_icon)
 					elif aux.get('type') == 'record':
 						stop_recording()
-						hide_recording_icon()
+						update_gui(hide_recording_icon)
 					elif aux.get('type') == 'pitch':
 						change_pitch(aux.get('value'))
 					elif aux.get('type') == 'volume':
 						change_volume(aux.get('value'))
 					elif aux.get('type') == 'preset':
 						change_preset(aux.get('value'))
-					elif aux.get('type') == 'metronome' and metronome_on:
+					elif aux.get('type') == 'metronome' and metronome_on and is_current_metronome(aux):
 						stop_metronome()
+					elif aux.get('type') == 'metronome' and metronome_on:
+						change_metronome(aux)
+						latency.record('metronome', start)
 					elif aux.get('type') == 'metronome':
 						start_metronome(aux)
+						latency.record('metronome', start)
 					elif aux.get('type') == 'keybinds':
 						swap_keybinds(aux.get('filename'))
 					elif aux.get('type') == 'run':
@@ -795,89 +813,147 @@ def convert_key_to_string(key):
 	if type(key) == str:
 		return key
 
-def on_press(key):
-	"""Sets the modifiers, adds the keys to the pressed keys list and 
-	and calls the play_event function."""
-	global alt_pressed, alt_r_pressed, ctrl_pressed, ctrl_r_pressed, is_recording
+def press_note(note, canonical, start):
+	"""Dispatch handler of notes. The note was already 
+	converted with the current pitch."""
+	if muted or awaiting_record_button:
+		pressed_keys[canonical] = ()
+		return False
+	engine[0].noteon(keyboard_channel, note, int(volume * 1.27))
+	latency.record('note', start)
+	pressed_keys[canonical] = (note,)
+	return True
+
+def press_chord(notes, canonical, start):
+	"""Dispatch handler of chords"""
+	if muted or awaiting_record_button:
+		pressed_keys[canonical] = ()
+		return False
+	velocity = int(volume * 1.27)
+	for note in notes:
+		engine[0].noteon(keyboard_channel, note, velocity)
+	latency.record('chord', start)
+	pressed_keys[canonical] = notes
+	return True
+
+def press_event(aux, canonical, start):
+	"""Dispatch handler of every other event, which 
+	is played by the event worker"""
+	pressed_keys[canonical] = ()
+	return False
+
+def set_modifier(key, pressed):
+	"""Updates the held modifiers and the modifier used by the next keys"""
+	global current_mod
+	held_modifiers[key] = pressed
+	current_mod = 'normal'
+	for mod in dispatch.modifiers:
+		if held_modifiers[mod]:
+			current_mod = mod
+			break
+
+def on_press(key, start=None):
+	"""Sets the modifiers and runs the key's handler from the dispatch 
+	table, which plays notes and chords right away. Everything else, 
+	including other events, is handed to the event worker so it 
+	can't delay the next key. The start of the key event can be 
+	given as a monotonic time in nanoseconds to measure latency."""
+	if start is None:
+		start = latency.now()
+	now = int(round(time.time() * 1000))
+	if key in held_modifiers:
+		set_modifier(key, True)
+		event_queue.put((finish_press, (key, None, False, now, start)))
+		return
+	mod = current_mod
+	entry = dispatch_table.get((mod, key))
+	if entry is None or entry[2] in pressed_keys:
+		event_queue.put((finish_press, (key, None, False, now, start)))
+		return
+	played = entry[0](entry[1], entry[2], start)
+	event_queue.put((finish_press, (key, mod, played, now, start)))
+
+def finish_press(key, mod, played, now, start):
+	"""Handles the part of a key press that isn't time critical"""
+	latency.record('queue', start)
 	print('\n' + key + ' pressed')
-	highlight_button(key)
-	if key == 'alt':
-		alt_pressed = True
-	elif key == 'alt_r':
-		alt_r_pressed = True
-	elif key == 'ctrl':
-		ctrl_pressed = True
-	elif key == 'ctrl_r':
-		ctrl_r_pressed = True
-	else:
-		if (not pressed_keys.get(key, False) 
-			and not pressed_keys.get(key.upper(), False)
-			and not pressed_keys.get(key.lower(), False)
-			and not pressed_keys.get(shift_keys.get(key), False)):
-			if alt_pressed:
-				add_pressed_keys('alt', key)
-				play_event('alt', key)
-			elif alt_r_pressed:
-				add_pressed_keys('alt_r', key)
-				play_event('alt_r', key)
-			elif ctrl_pressed:
-				add_pressed_keys('ctrl', key)
-				play_event('ctrl', key)
-			elif ctrl_r_pressed:
-				add_pressed_keys('ctrl_r', key)
-				play_event('ctrl_r', key)
-			else:
-				add_pressed_keys('normal', key)
-				play_event('normal', key)
-	
+	update_gui(highlight_button, key)
+	if mod is not None:
+		play_event(mod, key, played, now, start)
+
 def release_event(key):
 	"""Stops note or chord events and removes the given key from
 	the pressed keys list."""
-
-	fs = sequencers[0][0]
-
-	if not pressed_keys.get(key) == False:
-		event = pressed_keys.get(key).get('event')
-		if type(event) == list:
-			for note in event:
-				fs.noteoff(0, note)
-		elif type(event) == int:
-			fs.noteoff(0, event)
-		pressed_keys[key] = False
+	notes = pressed_keys.pop(canonical_keys.get(key, key), None)
+	if notes:
+		fs = engine[0]
+		for note in notes:
+			fs.noteoff(keyboard_channel, note)
 
 def on_release(key): 
 	"""This function is triggered when a key is released. 
 	Changes the format of the key name and checks if the key 
 	is one of the modifiers. If it's a normal key, triggers the
 	release_event function."""
-	global alt_pressed, alt_r_pressed, ctrl_pressed, ctrl_r_pressed, is_recording
+	now = int(round(time.time() * 1000))
+	if key in held_modifiers:
+		set_modifier(key, False)
+	else:
+		release_event(key)
+	event_queue.put((finish_release, (key, now)))
+
+def finish_release(key, now):
+	"""Handles the part of a key release that isn't time critical"""
 	print(key + ' released')
-	remove_highlight(key)
+	update_gui(remove_highlight, key)
 	if is_recording and key in recording_aux:
-		update_recording(key)
-	if key == 'alt':
-		alt_pressed = False
-	elif key == 'alt_r':
-		alt_r_pressed = False
-	elif key == 'ctrl':
-		ctrl_pressed = False
-	elif key == 'ctrl_r':
-		ctrl_r_pressed = False
-	else:
-		if pressed_keys.get(key, False):
-			release_event(key)		
-		elif pressed_keys.get(key.upper(), False):
-			release_event(key.upper())
-		elif pressed_keys.get(key.lower(), False):
-			release_event(key.lower())
-		elif key in shift_keys and shift_keys.get(key) in pressed_keys:
-			release_event(shift_keys.get(key))            
+		update_recording(key, now)
+
+def process_events():
+	"""Event worker. Runs the queued parts of key events in order, 
+	outside of the listener thread."""
+	while True:
+		function, args = event_queue.get()
+		try:
+			function(*args)
+		except Exception:
+			print('Invalid event!')
+
+def update_gui(function, *args):
+	"""Queues a change to the interface. Changes are applied 
+	in batches by the interface's thread."""
+	if not terminal:
+		gui_updates.append((function, args))
+
+def apply_gui_updates():
+	"""Applies every queued change to the interface and checks 
+	again after gui_interval. When the same change was queued 
+	more than once only its last occurrence is applied."""
+	batch = [gui_updates.popleft() for i in range(len(gui_updates))]
+	seen = set()
+	for i in range(len(batch) - 1, -1, -1):
+		if batch[i] in seen:
+			batch[i] = None
+		else:
+			seen.add(batch[i])
+	for update in batch:
+		if update is not None:
+			try:
+				update[0](*update[1])
+			except Exception:
+				pass
+	root.after(gui_interval, apply_gui_updates)
 
 def prepare_for_press(key):
-	on_press(convert_key_to_string(key))
+	start = latency.now()
+	key = convert_key_to_string(key)
+	keytrace.record(True, key)
+	on_press(key, start)
 
 def prepare_for_release(key):
-	on_release(convert_key_to_string(key))
+	key = convert_key_to_string(key)
+	keytrace.record(False, key)
+	on_release(key)
 
 def start_listener():
 	"""Starts the listener that is triggered when 
@@ -885,40 +961,86 @@ def start_listener():
 	the on_press function and on key releases triggers the 
 	on_release function"""
 	global listener
+	from pynput.keyboard import Listener
 	with Listener(
 		on_press = prepare_for_press,
 		on_release = prepare_for_release) as listener:
 		listener.join()
 	
-def start_sequencers():
-	"""Creates sequencers for each of the soundfonts
-	that are being used by the application"""
-	for soundfont in presets:
-		for preset in presets[soundfont]:
-			seq = fluidsynth.Sequencer()
-			fs = fluidsynth.Synth()
-			fs.start(driver='alsa')
-			sfid = fs.sfload(soundfont)
-			fs.program_select(preset, sfid, 0, 0)
-			synthID = seq.register_fluidsynth(fs)
-			presets[soundfont][preset] = [fs, seq, synthID, sfid]
-
 def count_presets():
 	"""Function that counts all the presets that are 
 	used in the songs that were imported, to then 
-	start sequencers for each of those presets"""
+	assign a channel of the synthesizer to each of them"""
 	global presets, songs, soundfont
 	for song in songs:
-		notes, options = songparser.pre_convert_song(song)
+		options = songparser.load_song_options(song)
 		preset, sf, bpm, signature = get_song_options(options)
-		if sf in presets:
-			presets[sf][preset] = []
-		else:
-			presets[sf] = {preset: []}
-	start_sequencers()
+		get_preset_channel(preset, sf)
+
+def run_benchmark(duration=2):
+	"""Triggers every song and metronome binding, lets them play 
+	for a while and stops them. Prints the trigger latency, the 
+	scheduling throughput and any event that was delivered after 
+	its song or metronome was stopped. Meant for the null backend."""
+	global background_songs
+	start = latency.now()
+	for mod in key_dict:
+		for key, aux in key_dict[mod].items():
+			if type(aux) != dict or key in background_songs:
+				continue
+			if aux.get('type') == 'song' and os.path.isfile(aux['filename']):
+				now = latency.now()
+				try:
+					play_song(key, aux)
+				except Exception:
+					print('Song file '+aux['filename']+' could not be played!')
+					continue
+				latency.record('song', now)
+			elif aux.get('type') == 'metronome' and not metronome_on:
+				now = latency.now()
+				start_metronome(aux)
+				latency.record('metronome', now)
+	elapsed = latency.now() - start
+	scheduled = sum(1 for event in list(backends.events) if event[1] == 'schedule')
+	time.sleep(duration)
+	clients = set()
+	for key in background_songs:
+		clients.update(stream['client'] for stream in scheduler.iter_streams(background_songs[key]['stream']))
+	if metronome_on:
+		clients.add(metronome['client'])
+		now = latency.now()
+		stop_metronome()
+		latency.record('stop', now)
+	now = latency.now()
+	stop()
+	latency.record('stop', now)
+	stopped = latency.now()
+	released = sum(1 for event in list(backends.events) if now <= event[0] <= stopped and event[1] == 'noteoff')
+	time.sleep(scheduler.lookahead / 1000 * 2)
+	late = [event for event in list(backends.events) if event[0] > stopped and event[1] == 'schedule' and event[3] in clients]
+	print('Scheduled ' + str(scheduled) + ' events in ' + str(round(elapsed / 1000000, 3)) + ' ms')
+	print('Events queued after stop: ' + str(len(late)))
+	print('Notes released on stop: ' + str(released))
+	latency.dump()
+
+def run_replay():
+	"""Plays the trace given as argument into the keyboard, waits 
+	for the event worker to handle every key and prints the 
+	throughput and latency of the replay"""
+	events = keytrace.load(replay_trace)
+	start = latency.now()
+	elapsed = keytrace.replay(events, on_press, on_release, replay_speed)
+	done = _thread.allocate_lock()
+	done.acquire()
+	event_queue.put((done.release, ()))
+	done.acquire()
+	handled = latency.now() - start
+	print('Replayed ' + str(len(events)) + ' key events in ' + str(round(elapsed / 1000000, 3)) + ' ms, ' 
+		+ str(round(len(events) / max(handled, 1) * 1000000000)) + ' events/s')
+	latency.dump()
 
 def check_arguments():
-	global keybinds, soundfont, terminal
+	global keybinds, soundfont, terminal, latency_report, benchmark, replay_trace, replay_speed, startup_report
 	args = parser.parse_args()
 	if args.keyboard is not None:
 		keybinds = args.keyboard
@@ -928,6 +1050,32 @@ def check_arguments():
 		soundfont = args.soundfont
 	if args.terminal is not None:
 		terminal = args.terminal
+	if args.audio_memory is not None:
+		audiocache.memory_budget = args.audio_memory * 1024 * 1024
+	if args.audio_workers is not None:
+		audiocache.workers = args.audio_workers
+	if args.audio_cache_size is not None:
+		audiocache.disk_quota = args.audio_cache_size * 1024 * 1024
+	if args.audio_rate is not None:
+		mixer.sample_rate = args.audio_rate
+	if args.audio_pitch_range is not None:
+		audiocache.pitch_range = args.audio_pitch_range
+	if args.latency_report is not None:
+		latency_report = args.latency_report
+		atexit.register(latency.export, latency_report)
+	backends.load_backend(args.backend)
+	if args.backend_log is not None:
+		atexit.register(backends.write_log, args.backend_log)
+	benchmark = args.benchmark
+	startup_report = args.startup_report
+	if args.record_trace is not None:
+		keytrace.start_recording()
+		atexit.register(keytrace.save, args.record_trace)
+	if args.replay_trace is not None:
+		replay_trace = args.replay_trace
+		replay_speed = args.replay_speed
+	if benchmark or replay_trace:
+		terminal = True
 
 def main():
 	"""Main function. Checks the given arguments to see if the 
@@ -936,13 +1084,46 @@ def main():
 	the program."""
 	global keybinds, soundfont
 	print('Loading...')
+	start = time.perf_counter()
 	set_keybinds()
+	record_startup('keybinds', start)
+	start = time.perf_counter()
+	start_engine()
+	record_startup('engine', start)
 	start_sequencer()
 	setup_metronome()
 	set_shiftkeys()
+	compile_dispatch_table()
+	start = time.perf_counter()
 	count_presets()
+	record_startup('presets', start)
+	_thread.start_new_thread(process_events, ())
+	startup_times['first playable note'] = time.perf_counter() - startup_start
 	print('Ready!')
-	start_listener()
+	if startup_report:
+		print_startup_report()
+	if benchmark:
+		run_benchmark()
+	elif replay_trace:
+		run_replay()
+	else:
+		start_listener()
+
+def load_icon(name):
+	"""Loads an icon resized for the interface. Resized icons are 
+	kept in the icon cache, so Pillow is only needed the first time 
+	an icon is used or after it changes."""
+	source = 'icons/' + name + '.png'
+	cached = icon_cache_directory + '/' + name + '-' + str(icon_size) + '.png'
+	if not os.path.isfile(cached) or os.path.getmtime(cached) < os.path.getmtime(source):
+		from PIL import Image
+		os.makedirs(icon_cache_directory, exist_ok=True)
+		image = Image.open(source).resize((icon_size, icon_size), Image.LANCZOS)
+		image.save(cached + '.tmp', format='PNG')
+		os.replace(cached + '.tmp', cached)
+	# Tk keeps no reference to its images, so they are kept here
+	icons[name] = PhotoImage(file=cached)
+	return icons[name]
 
 def highlight_button(key):
 	try:
@@ -957,7 +1138,7 @@ def remove_highlight(key):
 		pass
 
 def button_press(key, event):
-	on_press(key)
+	on_press(key, latency.now())
 
 def button_release(key, event):
 	on_release(key)
@@ -1094,6 +1275,8 @@ check_arguments()
 if terminal:
 	main()
 else:
+	from tkinter import *
+
 	_thread.start_new_thread(main, ())
 
 	root = Tk()
@@ -1136,68 +1319,46 @@ else:
 	Grid.rowconfigure(icon_frame, 7, weight=1)
 	Grid.columnconfigure(icon_frame, 0, weight=1)
 
-	muted_volume_icon = Image.open("icons/mute.png")
-	muted_volume_icon = muted_volume_icon.resize((30, 30), Image.ANTIALIAS)
-	muted_volume_icon = ImageTk.PhotoImage(muted_volume_icon)
-	muted_volume_label = Label(icon_frame, image = muted_volume_icon)
+	muted_volume_label = Label(icon_frame, image = load_icon("mute"))
 	muted_volume_label.grid(row=0, column=0)
 	muted_volume_label.grid_remove()
 
-	no_volume_icon = Image.open("icons/no_volume.png")
-	no_volume_icon = no_volume_icon.resize((30, 30), Image.ANTIALIAS)
-	no_volume_icon = ImageTk.PhotoImage(no_volume_icon)
-	no_volume_label = Label(icon_frame, image = no_volume_icon)
+	no_volume_label = Label(icon_frame, image = load_icon("no_volume"))
 	no_volume_label.grid(row=0, column=0)
 	no_volume_label.grid_remove()
 
-	low_volume_icon = Image.open("icons/low_volume.png")
-	low_volume_icon = low_volume_icon.resize((30, 30), Image.ANTIALIAS)
-	low_volume_icon = ImageTk.PhotoImage(low_volume_icon)
-	low_volume_label = Label(icon_frame, image = low_volume_icon)
+	low_volume_label = Label(icon_frame, image = load_icon("low_volume"))
 	low_volume_label.grid(row=0, column=0)
 	low_volume_label.grid_remove()
 
-	medium_volume_icon = Image.open("icons/medium_volume.png")
-	medium_volume_icon = medium_volume_icon.resize((30, 30), Image.ANTIALIAS)
-	medium_volume_icon = ImageTk.PhotoImage(medium_volume_icon)
-	medium_volume_label = Label(icon_frame, image = medium_volume_icon)
+	medium_volume_label = Label(icon_frame, image = load_icon("medium_volume"))
 	medium_volume_label.grid(row=0, column=0)
 	medium_volume_label.grid_remove()
 
-	high_volume_icon = Image.open("icons/high_volume.png")
-	high_volume_icon = high_volume_icon.resize((30, 30), Image.ANTIALIAS)
-	high_volume_icon = ImageTk.PhotoImage(high_volume_icon)
-	high_volume_label = Label(icon_frame, image = high_volume_icon)
+	high_volume_label = Label(icon_frame, image = load_icon("high_volume"))
 	high_volume_label.grid(row=0, column=0)
 
 	volume_num_label = Label(icon_frame, text=str(volume)+"%")
 	volume_num_label.grid(row=0, column=1)
 
-	pitch_icon = Image.open("icons/pitch.png")
-	pitch_icon = pitch_icon.resize((30, 30), Image.ANTIALIAS)
-	pitch_icon = ImageTk.PhotoImage(pitch_icon)
-	pitch_label = Label(icon_frame, image = pitch_icon)
+	pitch_label = Label(icon_frame, image = load_icon("pitch"))
 	pitch_label.grid(row=0, column=2)
 
 	pitch_num_label = Label(icon_frame, text=str(pitch))
 	pitch_num_label.grid(row=0, column=3)
 
-	metronome_icon = Image.open("icons/metronome.png")
-	metronome_icon = metronome_icon.resize((30, 30), Image.ANTIALIAS)
-	metronome_icon = ImageTk.PhotoImage(metronome_icon)
-	metronome_label = Label(icon_frame, image = metronome_icon)
+	metronome_label = Label(icon_frame, image = load_icon("metronome"))
 	metronome_label.grid(row=0, column=4)
 
 	metronome_text_label = Label(icon_frame, text="Off")
 	metronome_text_label.grid(row=0, column=5)
 
-	recording_icon = Image.open("icons/recording.png")
-	recording_icon = recording_icon.resize((30, 30), Image.ANTIALIAS)
-	recording_icon = ImageTk.PhotoImage(recording_icon)
-	recording_label = Label(icon_frame, image = recording_icon)
+	recording_label = Label(icon_frame, image = load_icon("recording"))
 	recording_label.grid(row=0, column=6)
 	recording_label.grid_remove()
 
+	root.after(gui_interval, apply_gui_updates)
+
 	try:
 		root.mainloop()
 	except KeyboardInterrupt:
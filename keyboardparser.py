@@ -1,6 +1,7 @@
-from lark import Lark
 from lark import Transformer
 
+import larkcache
+
 grammar = r"""
 
 ?start: ((_NL+)? line _NL+)*
@@ -27,6 +28,7 @@ assignment: note
           | preset
           | stop
           | reload
+          | stats
           | metronome
           | keybinds
           | run
@@ -50,6 +52,7 @@ mute: KEY MUTE
 preset: KEY PRESET NUMBER
 stop: KEY STOP
 reload: KEY RELOAD
+stats: KEY STATS
 metronome: KEY METRONOME NUMBER (TIME NUMBER)?
 keybinds: KEY KEYBINDS FILENAME
 run: KEY RUN (COMMAND)+
@@ -80,6 +83,7 @@ EXIT: /exit/i
 MUTE: /mute/i
 STOP: /stop/i
 RELOAD: /reload/i
+STATS: /stats/i
 METRONOME: /metronome/i
 TIME: /time|t/i
 KEYBINDS: /keybinds|k/i
@@ -95,130 +99,124 @@ COMMAND: /[^ \n]+/
 %ignore COMMENT
 %ignore " "
 """
-parser = Lark(grammar, parser="lalr", start="start")
-
-result = {}
-result["normal"] = {}
-result["ctrl"] = {}
-result["ctrl_r"] = {}
-result["alt"] = {}
-result["alt_r"] = {}
-
-mod = "normal"
-import_list = []
+parser = larkcache.build_parser("keyboardparser", grammar)
 
 class TreeTransformer(Transformer):
-    global mod, import_list
+    """Adds the keybinds of one file to the result. Imported files get 
+    their own transformer, which shares the result and the list of 
+    imported files, so the modifier of each file is kept separate."""
+
+    def __init__(self, result, import_list):
+        super().__init__()
+        self.result = result
+        self.import_list = import_list
+        self.mod = "normal"
 
     def note(self, items):
-        result[mod][items[0].value] = int(items[1].value)
+        self.result[self.mod][items[0].value] = int(items[1].value)
 
     def chord(self, items):
         notes = []
         for i in range(1,len(items)):
             notes.append(int(items[i].value))
-        result[mod][items[0].value] = notes
+        self.result[self.mod][items[0].value] = notes
 
     def volume(self, items):
-        result[mod][items[0].value] = {"type": "volume", "value": int(items[2].value)}
+        self.result[self.mod][items[0].value] = {"type": "volume", "value": int(items[2].value)}
 
     def pitch(self, items):
-        result[mod][items[0].value] = {"type": "pitch", "value": int(items[2].value)}
+        self.result[self.mod][items[0].value] = {"type": "pitch", "value": int(items[2].value)}
 
     def record(self, items):
-        result[mod][items[0].value] = {"type": "record"}
+        self.result[self.mod][items[0].value] = {"type": "record"}
         #if items[2].value == "append":
-        #    result[mod][items[0].value]["mode"] = "append"
+        #    self.result[self.mod][items[0].value]["mode"] = "append"
         #elif items[2]:
-        #    result[mod][items[0].value] = {"type": "record", "filename": items[2].value}
+        #    self.result[self.mod][items[0].value] = {"type": "record", "filename": items[2].value}
 
     def song(self, items):
-        result[mod][items[0].value] = {"type": "song", "filename": items[2].value}
+        self.result[self.mod][items[0].value] = {"type": "song", "filename": items[2].value}
         for i in range(2, len(items)):
             if items[i] == "loop" or items[i] == "l":
-                result[mod][items[0].value]["loop"] = int(items[i+1].value)
+                self.result[self.mod][items[0].value]["loop"] = int(items[i+1].value)
             elif items[i] == "pitch" or items[i] == "p":
-                result[mod][items[0].value]["pitch"] = int(items[i+1].value)
+                self.result[self.mod][items[0].value]["pitch"] = int(items[i+1].value)
     
     def audio(self, items):
-        result[mod][items[0].value] = {"type": "audio", "filename": items[2].value}
+        self.result[self.mod][items[0].value] = {"type": "audio", "filename": items[2].value}
         for i in range(2, len(items)):
             if items[i] == "start" or items[i] == "s":
-                result[mod][items[0].value]["start"] = int(items[i+1].value)
+                self.result[self.mod][items[0].value]["start"] = int(items[i+1].value)
             elif items[i] == "end" or items[i] == "e":
-                result[mod][items[0].value]["end"] = int(items[i+1].value)
+                self.result[self.mod][items[0].value]["end"] = int(items[i+1].value)
             elif items[i] == "volume" or items[i] == "v":
-                result[mod][items[0].value]["volume"] = int(items[i+1].value)
+                self.result[self.mod][items[0].value]["volume"] = int(items[i+1].value)
 
     def exit(self, items):
-        result[mod][items[0].value] = "exit"
+        self.result[self.mod][items[0].value] = "exit"
 
     def mute(self, items):
-        result[mod][items[0].value] = "mute"
+        self.result[self.mod][items[0].value] = "mute"
 
     def preset(self, items):
-        result[mod][items[0].value] = {"type": "preset", "value": int(items[2].value)}
+        self.result[self.mod][items[0].value] = {"type": "preset", "value": int(items[2].value)}
 
     def stop(self, items):
-        result[mod][items[0].value] = "stop"
+        self.result[self.mod][items[0].value] = "stop"
 
     def reload(self, items):
-        result[mod][items[0].value] = "reload"
+        self.result[self.mod][items[0].value] = "reload"
+
+    def stats(self, items):
+        self.result[self.mod][items[0].value] = "stats"
     
     def metronome(self, items):
-        result[mod][items[0].value] = {"type": "metronome", "bpm": int(items[2].value)}
+        self.result[self.mod][items[0].value] = {"type": "metronome", "bpm": int(items[2].value)}
         try:
-            result[mod][items[0].value]["time"] = int(items[4].value)
+            self.result[self.mod][items[0].value]["time"] = int(items[4].value)
         except:
             pass
     
     def keybinds(self, items):
-        result[mod][items[0].value] = {"type": "keybinds", "filename": items[2].value}
+        self.result[self.mod][items[0].value] = {"type": "keybinds", "filename": items[2].value}
 
     def myimport(self, items):
         aux = items[1].value
-        if aux not in import_list:
-            import_list.append(aux)
-            parse_file(aux)
+        if aux not in self.import_list:
+            self.import_list.append(aux)
+            parse_file(aux, self.result, self.import_list)
 
     def mymod(self, items):
-        global mod
-        mod = items[0].value
+        self.mod = items[0].value
     
     def run(self, items):
         command = []
         for i in range(2, len(items)):
             command.append(items[i])
-        result[mod][items[0].value] = {"type": "run", "command": command}
+        self.result[self.mod][items[0].value] = {"type": "run", "command": command}
 
     def defaultpreset(self, items):
-        result["config"]["preset"] = int(items[2].value)
+        self.result["config"]["preset"] = int(items[2].value)
     
     def defaultsoundfont(self, items):
-        result["config"]["soundfont"] = items[2].value
+        self.result["config"]["soundfont"] = items[2].value
 
     def defaultvolume(self, items):
-        result["config"]["volume"] = int(items[2].value)
+        self.result["config"]["volume"] = int(items[2].value)
 
     def defaultpitch(self, items):
-        result["config"]["pitch"] = int(items[2].value)
-
-def parse_file(filename):
-    global mod
-    mod = "normal"
+        self.result["config"]["pitch"] = int(items[2].value)
 
+def parse_file(filename, result, import_list):
     with open(filename, encoding="utf-8") as f:
         file_content = f.read()
         file_content = file_content + "\n"
     
     tree = parser.parse(file_content)
-    TreeTransformer().transform(tree)
-    mod = "normal"
+    TreeTransformer(result, import_list).transform(tree)
 
 def pre_parse_file(filename):
-    global import_list
-    import_list = []
-
+    result = {}
     result["config"] = {}
     result["normal"] = {}
     result["ctrl"] = {}
@@ -226,6 +224,6 @@ def pre_parse_file(filename):
     result["alt"] = {}
     result["alt_r"] = {}
 
-    parse_file(filename)
+    parse_file(filename, result, [])
 
     return result
@@ -0,0 +1,101 @@
+'''Recording and replay of key traces. A trace holds every key press
+and release of a session with its time, so the same session can be
+played again into the keyboard at its original speed, faster, or as
+fast as possible. Each line of a trace file holds the time of the
+event in microseconds, p or r for presses and releases, and the key.'''
+import argparse
+import random
+import threading
+import time
+
+header = 'KBE trace 1'
+
+recording = None
+recording_lock = threading.Lock()
+
+def start_recording():
+	global recording
+	recording = []
+
+def record(pressed, key):
+	"""Adds a key event to the trace being recorded"""
+	if recording is not None:
+		with recording_lock:
+			recording.append((time.monotonic_ns(), pressed, key))
+
+def save(filename, events=None):
+	"""Writes the recorded trace, or the given events, to a file"""
+	if events is None:
+		with recording_lock:
+			events = list(recording or [])
+	origin = events[0][0] if events else 0
+	with open(filename, 'w', encoding='utf-8') as f:
+		f.write(header + '\n')
+		for timestamp, pressed, key in events:
+			f.write(str((timestamp - origin) // 1000) + '\t' + ('p' if pressed else 'r') + '\t' + key + '\n')
+
+def load(filename):
+	"""Reads a trace file. Returns a list of (time, pressed, key)
+	tuples, with times in nanoseconds since the first event."""
+	events = []
+	with open(filename, encoding='utf-8') as f:
+		if f.readline().rstrip('\n') != header:
+			raise ValueError(filename + ' is not a key trace')
+		for line in f:
+			timestamp, pressed, key = line.rstrip('\n').split('\t', 2)
+			events.append((int(timestamp) * 1000, pressed == 'p', key))
+	return events
+
+def replay(events, on_press, on_release, speed=1.0, now=time.monotonic_ns):
+	"""Plays a trace into the press and release handlers. The trace
+	is played speed times faster than it was recorded, or as fast
+	as possible when speed is 0. Presses receive the time they were
+	due as their start, so lateness of the replay counts as latency.
+	Returns the time the replay took, in nanoseconds."""
+	origin = now()
+	for timestamp, pressed, key in events:
+		if speed > 0:
+			due = origin + int(timestamp / speed)
+			delay = due - now()
+			if delay > 0:
+				time.sleep(delay / 1000000000)
+		else:
+			due = now()
+		if pressed:
+			on_press(key, due)
+		else:
+			on_release(key)
+	return now() - origin
+
+def generate(key_dict, rate=50, count=1000, hold=0.05, seed=0):
+	"""Builds a trace of count presses of the notes, chords and songs
+	bound without modifiers, rate presses per second, each held for
+	hold seconds. The same seed always gives the same trace."""
+	keys = []
+	for key, value in key_dict.get('normal', {}).items():
+		if type(value) in (int, list) or (type(value) == dict and value.get('type') == 'song'):
+			keys.append(key)
+	keys.sort()
+	rng = random.Random(seed)
+	events = []
+	interval = int(1000000000 / rate)
+	for i in range(count):
+		key = rng.choice(keys)
+		events.append((i * interval, True, key))
+		events.append((i * interval + int(hold * 1000000000), False, key))
+	events.sort(key=lambda event: event[0])
+	return events
+
+if __name__ == '__main__':
+	import keyboardparser
+	arguments = argparse.ArgumentParser(description='Generates a key trace from the bindings of a keybinds file')
+	arguments.add_argument('output', help='File the trace is written to')
+	arguments.add_argument('-k', '--keyboard', default='keybinds/keybinds.txt', help='Keybinds file the keys are taken from')
+	arguments.add_argument('-r', '--rate', type=float, default=50, help='Key presses per second')
+	arguments.add_argument('-n', '--count', type=int, default=1000, help='Number of key presses')
+	arguments.add_argument('--hold', type=float, default=0.05, help='Time each key is held, in seconds')
+	arguments.add_argument('--seed', type=int, default=0)
+	args = arguments.parse_args()
+	events = generate(keyboardparser.pre_parse_file(args.keyboard), args.rate, args.count, args.hold, args.seed)
+	save(args.output, events)
+	print('Wrote ' + str(len(events)) + ' key events to ' + args.output)
@@ -0,0 +1,35 @@
+'''Builds the Lark parsers of the keyboard. Generating the parse tables
+of a grammar is slow, so Lark's own cache keeps them in the cache
+directory and loads them on every later launch, as long as the
+grammar, the options and the Lark version stay the same. The time
+taken by each parser is kept for the startup report.'''
+import os
+import time
+
+from lark import Lark
+
+cache_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'lark')
+
+timings = {}
+
+def get_mtime(filename):
+	try:
+		return os.stat(filename).st_mtime_ns
+	except OSError:
+		return None
+
+def build_parser(name, grammar, **options):
+	"""Returns an LALR parser for the grammar, loading its tables from
+	the cache when possible. The time taken is kept in timings."""
+	start = time.perf_counter()
+	filename = os.path.join(cache_directory, name + '.lark')
+	mtime = get_mtime(filename)
+	try:
+		os.makedirs(cache_directory, exist_ok=True)
+		parser = Lark(grammar, parser='lalr', cache=filename, **options)
+	except OSError:
+		parser = Lark(grammar, parser='lalr', **options)
+	# Lark only writes the cache file when it had to build the tables
+	action = 'loaded' if mtime is not None and get_mtime(filename) == mtime else 'built'
+	timings[name] = (time.perf_counter() - start, action)
+	return parser
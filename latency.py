@@ -0,0 +1,82 @@
+'''Latency histograms of the time between a key event and the
+sound it triggers, grouped by event type'''
+import json
+import threading
+import time
+
+bucket_count = 40
+
+histograms = {}
+histograms_lock = threading.Lock()
+
+def now():
+	"""Returns the current time of the monotonic clock in nanoseconds"""
+	return time.monotonic_ns()
+
+def get_bucket(elapsed):
+	"""Histogram buckets grow in powers of two, starting at one microsecond"""
+	return min(max(elapsed // 1000, 1).bit_length() - 1, bucket_count - 1)
+
+def record(event_type, start, end=None):
+	"""Adds the time elapsed since start, in nanoseconds,
+	to the histogram of the event type"""
+	if start is None:
+		return
+	if end is None:
+		end = time.monotonic_ns()
+	elapsed = end - start
+	with histograms_lock:
+		histogram = histograms.get(event_type)
+		if histogram is None:
+			histogram = {"count": 0, "total": 0, "max": 0, "buckets": [0] * bucket_count}
+			histograms[event_type] = histogram
+		histogram["count"] += 1
+		histogram["total"] += elapsed
+		if elapsed > histogram["max"]:
+			histogram["max"] = elapsed
+		histogram["buckets"][get_bucket(elapsed)] += 1
+
+def get_percentile(histogram, percentile):
+	"""Returns the upper bound of the bucket holding the percentile, in nanoseconds"""
+	target = histogram["count"] * percentile / 100
+	seen = 0
+	for i, count in enumerate(histogram["buckets"]):
+		seen += count
+		if count and seen >= target:
+			return min(2 ** (i + 1) * 1000, histogram["max"])
+	return histogram["max"]
+
+def get_stats():
+	"""Returns the count, mean, percentiles and maximum of every
+	event type, in microseconds"""
+	stats = {}
+	with histograms_lock:
+		for event_type, histogram in sorted(histograms.items()):
+			stats[event_type] = {
+				"count": histogram["count"],
+				"mean": round(histogram["total"] / histogram["count"] / 1000, 1),
+				"p50": round(get_percentile(histogram, 50) / 1000, 1),
+				"p95": round(get_percentile(histogram, 95) / 1000, 1),
+				"p99": round(get_percentile(histogram, 99) / 1000, 1),
+				"max": round(histogram["max"] / 1000, 1),
+				"buckets": list(histogram["buckets"])}
+	return stats
+
+def dump():
+	"""Prints the latency of every event type"""
+	print('Latency (us)    count       mean        p50        p95        p99        max')
+	for event_type, stats in get_stats().items():
+		line = event_type.ljust(12) + str(stats["count"]).rjust(9)
+		for column in ("mean", "p50", "p95", "p99", "max"):
+			line += str(stats[column]).rjust(11)
+		print(line)
+
+def export(filename):
+	"""Writes the statistics and histograms of every event type to a
+	JSON file. Bucket i counts events between 2^i and 2^(i+1) microseconds."""
+	with open(filename, 'w', encoding='utf-8') as f:
+		json.dump(get_stats(), f, indent=4)
+
+def reset():
+	with histograms_lock:
+		histograms.clear()
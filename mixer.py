@@ -0,0 +1,135 @@
+'''Software mixer for the audio events. Every clip plays through a
+single output stream of the current backend, which asks the mixer
+for each block of audio. Clips are kept in the mixer's format, so
+mixing a block only adds the playing clips together, at a cost that
+grows linearly with the number of voices.'''
+import audioop
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+import backends
+
+sample_rate = 44100
+channels = 2
+sample_width = 2
+block_size = 512
+max_voices = 32
+master_gain = 1.0
+
+voices = OrderedDict()
+voices_lock = threading.Lock()
+voice_ids = itertools.count(1)
+silence = {}
+output = None
+output_lock = threading.Lock()
+
+def start():
+	"""Opens the output stream, if it isn't open yet"""
+	global output
+	with output_lock:
+		if output is None:
+			output = backends.current.Output(sample_rate, channels, block_size, mix)
+
+def close():
+	global output
+	with output_lock:
+		if output is not None:
+			output.close()
+			output = None
+
+def convert_clip(data, num_channels, bytes_per_sample, rate):
+	"""Converts the frames of a wav file to the mixer's sample
+	width, number of channels and sample rate"""
+	if bytes_per_sample == 1:
+		# 8 bit wav files are unsigned
+		data = audioop.bias(data, 1, -128)
+	if bytes_per_sample != sample_width:
+		data = audioop.lin2lin(data, bytes_per_sample, sample_width)
+	if num_channels == 1:
+		data = audioop.tostereo(data, sample_width, 1, 1)
+	elif num_channels != channels:
+		raise ValueError('Clips with ' + str(num_channels) + ' channels are not supported')
+	if rate != sample_rate:
+		data = audioop.ratecv(data, sample_width, channels, rate, sample_rate, None)[0]
+	return data
+
+def play(clip, gain=1.0):
+	"""Starts playing a converted clip and returns the id of its voice.
+	When every voice is in use the oldest one is stopped."""
+	voice = {"clip": memoryview(clip), "position": 0, "gain": gain}
+	with voices_lock:
+		voice_id = next(voice_ids)
+		while len(voices) >= max_voices:
+			voices.popitem(last=False)
+		voices[voice_id] = voice
+	start()
+	return voice_id
+
+def stop(voice_id):
+	with voices_lock:
+		voices.pop(voice_id, None)
+
+def is_playing(voice_id):
+	return voice_id in voices
+
+def set_gain(voice_id, gain):
+	with voices_lock:
+		if voice_id in voices:
+			voices[voice_id]["gain"] = gain
+
+def set_master_gain(gain):
+	"""Changes the gain applied to every voice"""
+	global master_gain
+	master_gain = gain
+
+def mix(frames):
+	"""Returns the next block of audio, with every playing voice
+	added together. Voices that reach the end of their clip stop."""
+	size = frames * channels * sample_width
+	if size not in silence:
+		silence[size] = bytes(size)
+	block = silence[size]
+	with voices_lock:
+		playing = list(voices.items())
+	finished = []
+	for voice_id, voice in playing:
+		position = voice["position"]
+		chunk = voice["clip"][position:position + size]
+		voice["position"] = position + size
+		if len(chunk) < size:
+			finished.append(voice_id)
+			chunk = bytes(chunk) + silence[size][len(chunk):]
+		gain = voice["gain"] * master_gain
+		if gain != 1.0:
+			chunk = audioop.mul(chunk, sample_width, gain)
+		block = audioop.add(block, chunk, sample_width)
+	if finished:
+		with voices_lock:
+			for voice_id in finished:
+				voices.pop(voice_id, None)
+	return block
+
+def benchmark(blocks=2000):
+	"""Measures the time taken to mix a block for different numbers
+	of voices, against the time the block takes to play"""
+	import os
+	global max_voices
+	clip = os.urandom(blocks * block_size * channels * sample_width)
+	duration = block_size / sample_rate * 1000000
+	max_voices = 64
+	for count in (1, 4, 16, 32, 64):
+		voices.clear()
+		for i in range(count):
+			voices[next(voice_ids)] = {"clip": memoryview(clip), "position": 0, "gain": 0.5}
+		start = time.perf_counter()
+		for i in range(blocks):
+			mix(block_size)
+		elapsed = (time.perf_counter() - start) / blocks * 1000000
+		print(str(count).rjust(3) + ' voices: ' + str(round(elapsed, 1)) + ' us per block, '
+			+ str(round(elapsed / duration * 100, 2)) + '% of real time')
+	voices.clear()
+
+if __name__ == '__main__':
+	benchmark()
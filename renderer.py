@@ -0,0 +1,273 @@
+'''Offline rendering of songs to WAV files. The notes of a song and of
+every song it calls are collected ahead of time and the synthesizer
+is asked for the samples between them directly, so a song renders as
+fast as the CPU allows instead of in real time.'''
+import argparse
+import hashlib
+import json
+import os
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+
+import backends
+import scheduler
+import songparser
+
+soundfont = "/usr/share/sounds/sf2/FluidR3_GM.sf2"
+sample_rate = 44100
+block_size = 4096
+tail = 2000
+
+drum_channel = 9
+
+workers = None
+hashes = {}
+
+def get_song_settings(options, sf):
+	"""Returns the preset, soundfont and bpm of a song"""
+	return options.get('preset', 0), options.get('soundfont', sf), options.get('bpm', 0)
+
+def get_channel(channels, preset, sf):
+	"""Returns the channel of a preset, assigning the next free one
+	the first time the preset is used. The drum channel is skipped."""
+	if (sf, preset) not in channels:
+		channel = len(channels)
+		if channel >= drum_channel:
+			channel += 1
+		channels[(sf, preset)] = channel
+	return channels[(sf, preset)]
+
+def collect_events(filename, loop=1, pitch=0, origin=0, sf=None, events=None, channels=None, depth=0):
+	"""Returns every note event of a song as (time, kind, channel, key,
+	velocity) tuples sorted by time in milliseconds, along with the
+	channel assigned to each soundfont and preset. Songs called from
+	the song are included, with their own loops and pitch."""
+	if sf is None:
+		sf = soundfont
+	if events is None:
+		events = []
+	if channels is None:
+		channels = {}
+	notes, options = songparser.load_song(filename)
+	preset, song_sf, bpm = get_song_settings(options, sf)
+	channel = get_channel(channels, preset, song_sf)
+	timeline, length = scheduler.get_timeline(filename, notes, bpm)
+	if not timeline:
+		loop = 0
+	for i in range(loop):
+		start = origin + i * length
+		for entry in timeline:
+			if entry[1] == scheduler.SONG:
+				if depth < scheduler.max_depth:
+					obj = entry[2]
+					try:
+						collect_events(obj['filename'], obj.get('loop', 1), pitch + obj.get('pitch', 0),
+							start + entry[0], sf, events, channels, depth + 1)
+					except Exception:
+						print('Song file '+obj.get('filename', '')+' could not be played!')
+				continue
+			key = scheduler.convert_into_final_note(entry[2], pitch)
+			events.append((start + entry[0], entry[1], entry[3] if entry[3] is not None else channel, key, entry[4]))
+	if depth == 0:
+		events.sort(key=lambda event: (event[0], event[1]))
+	return events, channels
+
+def write_frames(synth, output, frames):
+	"""Synthesizes frames of audio into the WAV file in blocks"""
+	while frames > 0:
+		block = min(frames, block_size)
+		output.writeframesraw(synth.write_s16(block))
+		frames -= block
+
+def render(filename, output, sf=None, loop=1, pitch=0, rate=None, gain=0.2):
+	"""Renders a song into a 16 bit stereo WAV file.
+	Returns the duration of the rendered audio in seconds."""
+	if rate is None:
+		rate = sample_rate
+	events, channels = collect_events(filename, loop, pitch, sf=sf)
+	synth = backends.current.Synth(gain=gain, samplerate=rate)
+	sfids = {}
+	for (song_sf, preset), channel in channels.items():
+		if song_sf not in sfids:
+			sfids[song_sf] = synth.sfload(song_sf)
+		synth.program_select(channel, sfids[song_sf], 0, preset)
+	frame = 0
+	with wave.open(output, 'wb') as w:
+		w.setnchannels(2)
+		w.setsampwidth(2)
+		w.setframerate(rate)
+		for event_time, kind, channel, key, velocity in events:
+			target = event_time * rate // 1000
+			write_frames(synth, w, target - frame)
+			frame = max(frame, target)
+			if kind == scheduler.NOTE_ON:
+				synth.noteon(channel, key, velocity)
+			else:
+				synth.noteoff(channel, key)
+		write_frames(synth, w, tail * rate // 1000)
+		frame += tail * rate // 1000
+	synth.delete()
+	return frame / rate
+
+def hash_file(filename):
+	"""Returns the sha256 of a file, reusing the previous hash 
+	while its modification time and size stay the same"""
+	stat = os.stat(filename)
+	key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+	if key not in hashes:
+		digest = hashlib.sha256()
+		with open(filename, 'rb') as f:
+			for chunk in iter(partial(f.read, 1024 * 1024), b''):
+				digest.update(chunk)
+		hashes[key] = digest.hexdigest()
+	return hashes[key]
+
+def get_song_sources(filename, sf=None, sources=None, depth=0):
+	"""Returns the song files and soundfonts a song is rendered from,
+	including the ones of the songs it calls"""
+	if sf is None:
+		sf = soundfont
+	if sources is None:
+		sources = set()
+	if filename in sources or depth > scheduler.max_depth:
+		return sources
+	sources.add(filename)
+	try:
+		notes, options = songparser.load_song(filename)
+	except Exception:
+		return sources
+	sources.add(get_song_settings(options, sf)[1])
+	for note in notes:
+		if type(note) == dict and note['type'] == 'song':
+			get_song_sources(note['filename'], sf, sources, depth + 1)
+	return sources
+
+def get_render_key(filename, sf, rate, backend, gain):
+	"""Returns a hash of the contents of every source of a song and 
+	of the settings it is rendered with"""
+	values = [rate, tail, backend, gain]
+	for source in sorted(get_song_sources(filename, sf)):
+		try:
+			values.append([source, hash_file(source)])
+		except OSError:
+			values.append([source, None])
+	return hashlib.sha256(json.dumps(values).encode('utf-8')).hexdigest()
+
+def get_batch_outputs(directories, output_directory):
+	"""Returns every song inside the directories along with the WAV file
+	it is rendered to, under a folder named after its directory, so
+	absolute paths and .. never leave the output directory"""
+	outputs = []
+	for directory in directories:
+		folder = os.path.basename(os.path.abspath(directory))
+		for song in songparser.find_song_files([directory]):
+			name = os.path.splitext(os.path.relpath(song, directory))[0] + '.wav'
+			outputs.append((song, os.path.join(output_directory, folder, name)))
+	return outputs
+
+def is_song(filename, manifest):
+	"""Checks that a file parses as a song. Files that don't are 
+	recorded in the manifest with their hash, so they are only 
+	parsed again once they change."""
+	invalid = 'not a song ' + hash_file(filename)
+	if manifest.get(filename) == invalid:
+		return False
+	try:
+		songparser.load_song(filename)
+	except Exception:
+		manifest[filename] = invalid
+		return False
+	return True
+
+def write_manifest(filename, manifest):
+	with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+		json.dump(manifest, f, indent=4)
+	os.replace(filename + '.tmp', filename)
+
+def render_job(backend, filename, output, sf, rate, gain):
+	"""Renders one song inside a worker process.
+	Returns the duration of the audio and the time it took."""
+	if backends.current is None or backends.current.name != backend:
+		backends.load_backend(backend)
+	os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+	start = time.perf_counter()
+	try:
+		duration = render(filename, output + '.tmp', sf, rate=rate, gain=gain)
+	except Exception as e:
+		# Parser errors can't be sent back from the worker
+		raise RuntimeError(str(e).strip().splitlines()[0]) from None
+	os.replace(output + '.tmp', output)
+	return duration, time.perf_counter() - start
+
+def render_batch(directories, output_directory, sf=None, rate=None, backend='alsa', gain=0.2):
+	"""Renders every song inside the directories into the output 
+	directory, one song per worker process. Songs whose sources and 
+	settings didn't change since the last batch are skipped."""
+	if rate is None:
+		rate = sample_rate
+	manifest_filename = os.path.join(output_directory, 'manifest.json')
+	try:
+		with open(manifest_filename, encoding='utf-8') as f:
+			manifest = json.load(f)
+	except (OSError, ValueError):
+		manifest = {}
+	jobs = {}
+	os.makedirs(output_directory, exist_ok=True)
+	for song, output in get_batch_outputs(directories, output_directory):
+		if not is_song(song, manifest):
+			print('Skipped ' + song + ', not a song')
+			continue
+		key = get_render_key(song, sf, rate, backend, gain)
+		if manifest.get(song) == key and os.path.isfile(output):
+			print('Skipped ' + song + ', unchanged')
+			continue
+		jobs[song] = (output, key)
+	write_manifest(manifest_filename, manifest)
+	start = time.perf_counter()
+	total = 0
+	rendered = 0
+	with ProcessPoolExecutor(max_workers=workers) as pool:
+		futures = {pool.submit(render_job, backend, song, jobs[song][0], sf, rate, gain): song for song in jobs}
+		for i, future in enumerate(as_completed(futures)):
+			song = futures[future]
+			progress = '[' + str(i + 1) + '/' + str(len(futures)) + '] '
+			try:
+				duration, elapsed = future.result()
+			except Exception as e:
+				print('Render ' + progress + song + ' failed: ' + str(e))
+				continue
+			total += duration
+			rendered += 1
+			manifest[song] = jobs[song][1]
+			write_manifest(manifest_filename, manifest)
+			print('Render ' + progress + song + ': ' + str(round(duration, 2)) + ' s in ' + str(round(elapsed, 2)) + ' s ('
+				+ str(round(duration / max(elapsed, 0.000001), 1)) + 'x real time)')
+	elapsed = time.perf_counter() - start
+	print('Rendered ' + str(rendered) + ' songs, ' + str(round(total, 2)) + ' s of audio in ' + str(round(elapsed, 2)) + ' s ('
+		+ str(round(total / max(elapsed, 0.000001), 1)) + 'x real time)')
+
+if __name__ == '__main__':
+	arguments = argparse.ArgumentParser(description='Renders a song file to a WAV file, or every song of a few directories')
+	arguments.add_argument('song', help='Song file to render, or the first directory of a batch')
+	arguments.add_argument('output', nargs='+', help='WAV file to write, or more directories followed by the output directory of a batch')
+	arguments.add_argument('--batch', action='store_true', help='Renders every song inside the directories in a pool of processes')
+	arguments.add_argument('-w', '--workers', type=int, help='Number of processes used by a batch')
+	arguments.add_argument('-s', '--soundfont', help='Soundfont used by songs that don\'t set one')
+	arguments.add_argument('-l', '--loop', type=int, default=1, help='Number of times the song is played')
+	arguments.add_argument('-p', '--pitch', type=int, default=0, help='Pitch added to every note')
+	arguments.add_argument('-r', '--rate', type=int, default=sample_rate, help='Sample rate of the WAV file')
+	arguments.add_argument('-g', '--gain', type=float, default=0.2, help='Gain of the synthesizer')
+	arguments.add_argument('-b', '--backend', choices=['alsa', 'null'], default='alsa', help='Synthesizer backend, null renders silence')
+	args = arguments.parse_args()
+	if args.batch:
+		workers = args.workers
+		render_batch([args.song] + args.output[:-1], args.output[-1], args.soundfont, args.rate, args.backend, args.gain)
+		raise SystemExit
+	backends.load_backend(args.backend)
+	start = time.perf_counter()
+	duration = render(args.song, args.output[0], args.soundfont, args.loop, args.pitch, args.rate, args.gain)
+	elapsed = time.perf_counter() - start
+	print('Rendered ' + str(round(duration, 2)) + ' s of audio in ' + str(round(elapsed, 2)) + ' s ('
+		+ str(round(duration / max(elapsed, 0.000001), 1)) + 'x real time)')
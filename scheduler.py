@@ -0,0 +1,254 @@
+'''Look-ahead scheduling of songs into a sequencer of one of the
+backends. Only the events that fall inside the look-ahead window are
+queued, the rest are added from a sequencer timer as the song plays.'''
+import threading
+from functools import partial
+
+lookahead = 500
+max_depth = 16
+metronome_bars = 2
+
+timelines = {}
+
+NOTE_OFF = 0
+NOTE_ON = 1
+SONG = 2
+
+def convert_start_end(start, end, bpm):
+	bpm = 60000/bpm
+	start *= bpm
+	end *= bpm
+	return int(start), int(end)
+
+def convert_into_final_note(note, pitch):
+	final_note = note + pitch
+	if final_note < 0:
+		final_note = 0
+	elif final_note > 127:
+		final_note = 127
+	return final_note
+
+def build_timeline(notes, bpm):
+	"""Converts the events of a song into a list of entries sorted by
+	their time in milliseconds. Returns the list and the duration of
+	a single iteration of the song."""
+	timeline = []
+	length = 0
+	offset = 0
+	for note in notes:
+		if type(note) == dict:
+			if note['type'] == 'song':
+				timeline.append((offset + note.get('start', 0), SONG, note, None, 0))
+			elif note['type'] == 'pause':
+				offset += note['value']
+			continue
+		try:
+			channel = note[3]
+		except IndexError:
+			channel = None
+		try:
+			velocity = note[4]
+		except IndexError:
+			velocity = 100
+		if bpm != 0:
+			note_start, note_end = convert_start_end(note[1], note[2], bpm)
+		else:
+			note_start = int(note[1])
+			note_end = int(note[2])
+		note_start += offset
+		if type(note[0]) == list:
+			keys = note[0]
+		else:
+			keys = [note[0]]
+		for key in keys:
+			timeline.append((note_start, NOTE_ON, key, channel, velocity))
+			timeline.append((note_start + note_end, NOTE_OFF, key, channel, 0))
+		if note_start + note_end > length:
+			length = note_start + note_end
+	timeline.sort(key=lambda entry: (entry[0], entry[1]))
+	return timeline, length
+
+def get_timeline(filename, notes, bpm):
+	"""Returns the timeline of a song, reusing the previous one
+	if the song's events didn't change since it was built.
+	Only the last timeline of each song file is kept."""
+	cached = timelines.get(filename)
+	if cached is not None and cached[0] is notes and cached[1] == bpm:
+		return cached[2], cached[3]
+	timeline, length = build_timeline(notes, bpm)
+	timelines[filename] = (notes, bpm, timeline, length)
+	return timeline, length
+
+def start_stream(seq, dest, timeline, length, loop, pitch, origin, channel=0, on_song=None, on_end=None, depth=0):
+	"""Starts playing a timeline at the sequencer tick given as origin.
+	Only the first look-ahead window is queued before returning."""
+	if not timeline:
+		loop = 0
+	stream = {"seq": seq, "dest": dest, "timeline": timeline, "length": length,
+			  "loop": loop, "pitch": pitch, "origin": origin, "channel": channel,
+			  "end": origin + loop * length, "iteration": 0, "index": 0,
+			  "active": True, "on_song": on_song, "on_end": on_end, "depth": depth,
+			  "children": [], "voices": {}, "lock": threading.Lock()}
+	stream["client"] = seq.register_client("stream", partial(stream_callback, stream))
+	fill_window(stream)
+	return stream
+
+def fill_window(stream):
+	"""Queues every event of the stream up to the end of the
+	look-ahead window and sets a timer to queue the next ones. 
+	Holds the stream's lock, so a stream stopped from another 
+	thread never queues events once stop_stream returns."""
+	seq = stream["seq"]
+	timeline = stream["timeline"]
+	with stream["lock"]:
+		if not stream["active"]:
+			return
+		now = seq.get_tick()
+		horizon = now + lookahead
+		release_voices(stream, now)
+		while stream["iteration"] < stream["loop"]:
+			entry = timeline[stream["index"]]
+			time = stream["origin"] + stream["iteration"] * stream["length"] + entry[0]
+			if time > horizon:
+				break
+			schedule_entry(stream, entry, time)
+			stream["index"] += 1
+			if stream["index"] == len(timeline):
+				stream["index"] = 0
+				stream["iteration"] += 1
+		if stream["iteration"] < stream["loop"]:
+			seq.timer(now + lookahead // 2, source=stream["client"], dest=stream["client"])
+		else:
+			seq.timer(max(stream["end"], now), source=stream["client"], dest=stream["client"])
+
+def schedule_entry(stream, entry, time):
+	seq = stream["seq"]
+	if entry[1] == SONG:
+		if stream["on_song"] is not None and stream["depth"] < max_depth:
+			child = stream["on_song"](stream, entry[2], time)
+			if child is not None:
+				stream["children"].append(child)
+		return
+	channel = entry[3]
+	if channel is None:
+		channel = stream["channel"]
+	key = convert_into_final_note(entry[2], stream["pitch"])
+	if entry[1] == NOTE_ON:
+		stream["voices"].setdefault((channel, key), []).append([time, None])
+		seq.note_on(time=time, channel=channel, key=key, velocity=entry[4], source=stream["client"], dest=stream["dest"])
+	else:
+		# The note off ends the oldest note of the key still playing
+		for voice in stream["voices"].get((channel, key), []):
+			if voice[1] is None:
+				voice[1] = time
+				break
+		seq.note_off(time=time, channel=channel, key=key, source=stream["client"], dest=stream["dest"])
+
+def stream_callback(stream, time, event, seq, data):
+	"""Called by the sequencer timer, either to refill the window
+	or once every event of the stream has been played"""
+	with stream["lock"]:
+		if not stream["active"]:
+			return
+		finished = stream["iteration"] >= stream["loop"]
+		if finished:
+			stream["active"] = False
+	if not finished:
+		fill_window(stream)
+	elif stream["on_end"] is not None:
+		stream["on_end"](stream)
+
+def stop_stream(stream):
+	"""Stops queueing events for the stream and the songs it started.
+	Each stream is stopped before its children are listed, so it 
+	can't start another song afterwards."""
+	for s in iter_streams(stream):
+		with s["lock"]:
+			s["active"] = False
+
+def iter_streams(stream):
+	"""Yields the stream followed by every stream started from it"""
+	yield stream
+	for child in list(stream["children"]):
+		yield from iter_streams(child)
+
+def release_voices(stream, now):
+	"""Forgets the notes of the stream whose note off was played. 
+	Each channel and key keeps the start and end of its notes, as
+	the look-ahead window can hold several notes of the same key."""
+	voices = stream["voices"]
+	for voice in list(voices):
+		voices[voice] = [interval for interval in voices[voice] if interval[1] is None or interval[1] > now]
+		if not voices[voice]:
+			del voices[voice]
+
+def get_sounding_keys(stream, now):
+	"""Returns the channel and final key of every note of the stream
+	that started before now and wasn't released yet, once per note. 
+	Once the queued events of the stream are removed, these are the 
+	only notes left to release."""
+	keys = []
+	with stream["lock"]:
+		for voice, intervals in stream["voices"].items():
+			for on, off in intervals:
+				if on <= now and (off is None or off > now):
+					keys.append(voice)
+	return keys
+
+def start_metronome_stream(seq, dest, bpm, time=1, channel=0):
+	"""Starts a metronome that keeps a few bars of beats queued
+	and adds the next bar from a sequencer timer"""
+	metronome = {"seq": seq, "dest": dest, "channel": channel, "bpm": bpm, "time": time,
+				 "duration": int(60000 / bpm), "beat": 0, "tick": seq.get_tick(), "active": True}
+	metronome["client"] = seq.register_client("metronome", partial(metronome_callback, metronome))
+	fill_metronome(metronome)
+	return metronome
+
+def fill_metronome(metronome):
+	"""Queues beats until the metronome is the configured amount
+	of bars ahead of the sequencer and sets the next refill timer"""
+	seq = metronome["seq"]
+	now = seq.get_tick()
+	bar = metronome["duration"] * metronome["time"]
+	horizon = now + bar * metronome_bars
+	while metronome["tick"] <= horizon:
+		if metronome["beat"] == 0:
+			key = 67
+		else:
+			key = 68
+		tick = metronome["tick"]
+		seq.note_on(time=tick, channel=metronome["channel"], key=key, velocity=100, source=metronome["client"], dest=metronome["dest"])
+		seq.note_off(time=tick + metronome["duration"], channel=metronome["channel"], key=key, source=metronome["client"], dest=metronome["dest"])
+		metronome["tick"] += metronome["duration"]
+		metronome["beat"] = (metronome["beat"] + 1) % metronome["time"]
+	seq.timer(now + bar, source=metronome["client"], dest=metronome["client"])
+
+def metronome_callback(metronome, time, event, seq, data):
+	if metronome["active"]:
+		fill_metronome(metronome)
+
+def change_metronome_stream(metronome, bpm, time=1):
+	"""Changes the tempo and time signature of a running metronome.
+	Queued beats are dropped and the new ones start where the 
+	next beat would have played."""
+	seq = metronome["seq"]
+	seq.remove_events(metronome["client"])
+	now = seq.get_tick()
+	pending = max(metronome["tick"] - now - 1, 0) // metronome["duration"]
+	metronome["tick"] -= pending * metronome["duration"]
+	metronome["beat"] = (metronome["beat"] - pending) % metronome["time"] % time
+	for key in (67, 68):
+		seq.note_off(time=metronome["tick"], channel=metronome["channel"], key=key, source=metronome["client"], dest=metronome["dest"])
+	metronome["bpm"] = bpm
+	metronome["time"] = time
+	metronome["duration"] = int(60000 / bpm)
+	fill_metronome(metronome)
+
+def stop_metronome_stream(metronome):
+	"""Stops the metronome and drops the beats it still had queued"""
+	seq = metronome["seq"]
+	metronome["active"] = False
+	seq.remove_events(metronome["client"])
+	seq.unregister_client(metronome["client"])
+	for key in (67, 68):
+		seq.note_off(time=seq.get_tick(), channel=metronome["channel"], key=key, dest=metronome["dest"])
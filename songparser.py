@@ -1,6 +1,16 @@
-from lark import Lark
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
 from lark import Transformer
 
+import larkcache
+
 grammar = r"""
 
 ?start: ((_NL+)? event _NL+)*
@@ -39,19 +49,52 @@ NUMORSIG: /[0-9]+(\/[0-9]+)?/
 %ignore COMMENT
 %ignore " "
 """
-parser = Lark(grammar, parser="lalr", start="start")
+parser = larkcache.build_parser("songparser", grammar)
+
+song_cache = {}
+use_lark = False
 
-result = []
-options = {}
+# The terminals of the grammar. Lark's contextual lexer only tries the
+# terminals the parser expects next, the first one that matches wins,
+# and the patterns without a maximum length are tried before comments
+# and keywords. Whitespace between tokens is optional.
+TERMINALS = {
+    "NUMBER": re.compile(r"[0-9]+[eE][+-]?[0-9]+|(?:[0-9]+\.(?:[0-9]+)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?|[0-9]+"),
+    "FILENAME": re.compile(r"[\w/.,-]+\.[A-Za-z0-9]+"),
+    "NUMORSIG": re.compile(r"[0-9]+(?:/[0-9]+)?"),
+    "SOUNDFONT": re.compile(r"soundfont", re.IGNORECASE),
+    "PRESET": re.compile(r"preset|p", re.IGNORECASE),
+    "BPM": re.compile(r"bpm", re.IGNORECASE),
+    "START": re.compile(r"start|s", re.IGNORECASE),
+    "DURATION": re.compile(r"duration|d", re.IGNORECASE),
+    "LOOP": re.compile(r"loop|l", re.IGNORECASE),
+}
+UNBOUNDED_TERMINALS = ("NUMBER", "FILENAME", "NUMORSIG")
+WHITESPACE_PATTERN = re.compile(r"[ \t]*")
+OPTION_EVENTS = {"preset": "value", "soundfont": "filename", "bpm": "value"}
+
+SIDECAR_EXTENSION = ".kbes"
+SIDECAR_MAGIC = b"KBES"
+SIDECAR_VERSION = 1
+SIDECAR_HEADER = struct.Struct("<4sHHII")
+FLAG_CHORD = 1
+FLAG_FLOAT = 2
+FLAG_EXTENDED = 4
 
 class TreeTransformer(Transformer):
-    global result, options
+    """Collects the events and options of one song. Every parse 
+    uses a new transformer, so songs can be parsed concurrently."""
+
+    def __init__(self):
+        super().__init__()
+        self.result = []
+        self.options = {}
 
     def note(self, items):
         if '/' in items[2].value or '/' in items[4].value:
-            result.append([int(items[0].value), convert_to_float(items[2].value), convert_to_float(items[4].value)])
+            self.result.append([int(items[0].value), convert_to_float(items[2].value), convert_to_float(items[4].value)])
         else:
-            result.append([int(items[0].value), int(items[2].value), int(items[4].value)])
+            self.result.append([int(items[0].value), int(items[2].value), int(items[4].value)])
 
     def chord(self, items):
         notes = []
@@ -60,9 +103,9 @@ class TreeTransformer(Transformer):
                 break
             notes.append(int(items[i]))
         if '/' in items[i+1].value or '/' in items[i+3].value:
-            result.append([notes, convert_to_float(items[i+1].value), convert_to_float(items[i+3].value)])
+            self.result.append([notes, convert_to_float(items[i+1].value), convert_to_float(items[i+3].value)])
         else:
-            result.append([notes, int(items[i+1].value), int(items[i+3].value)])
+            self.result.append([notes, int(items[i+1].value), int(items[i+3].value)])
         
     def song(self, items):
         song = {}
@@ -79,22 +122,22 @@ class TreeTransformer(Transformer):
                     song["loop"] = int(items[4].value)
             except:
                 pass
-            result.append(song)
+            self.result.append(song)
 
     def pause(self, items):
         if '/' in items[1].value or '/' in items[1].value:
-            result.append({"type": "pause", "value": convert_to_float(items[1].value)})
+            self.result.append({"type": "pause", "value": convert_to_float(items[1].value)})
         else:
-            result.append({"type": "pause", "value": int(items[1].value)})
+            self.result.append({"type": "pause", "value": int(items[1].value)})
 
     def preset(self, items):
-        options["preset"] = int(items[1].value) 
+        self.options["preset"] = int(items[1].value) 
 
     def soundfont(self, items):
-        options["soundfont"] = items[1].value
+        self.options["soundfont"] = items[1].value
 
     def bpm(self, items):
-        options["bpm"] = int(items[1].value)
+        self.options["bpm"] = int(items[1].value)
 
 def convert_to_float(fraction):
     try:
@@ -109,6 +152,144 @@ def convert_to_float(fraction):
         fraction = float(num) / float(denom)
         return whole - fraction if whole < 0 else whole + fraction
 
+def iter_song(filename):
+    """Yields the events of a song file one at a time, reading the file 
+    line by line, so memory doesn't grow with the size of the song"""
+    with open(filename, encoding="utf-8") as f:
+        yield from iter_song_lines(f)
+
+def iter_song_lines(lines):
+    """Yields the events of the lines of a song in the order they appear.
+    Options are yielded as events too, in the same format used by 
+    convert_song_to_text: {"type": "preset", "value": 0}, 
+    {"type": "soundfont", "filename": "a.sf2"} and {"type": "bpm", "value": 120}.
+    Raises ValueError on the lines the grammar doesn't accept."""
+    tokens = []
+    after_comment = False
+    newlines = False
+    parsed = 0
+    for number, line in enumerate(lines, 1):
+        if after_comment and line in ("\n", ""):
+            continue
+        after_comment = False
+        position = 0
+        while True:
+            position = WHITESPACE_PATTERN.match(line, position).end()
+            if line.startswith(("\n", "\r\n"), position) or position == len(line):
+                break
+            token = match_song_token(line, position, get_expected_terminals(tokens))
+            if token is None:
+                if line.startswith("//", position):
+                    # Comments swallow their newline, so the event goes on in the next line
+                    after_comment = True
+                    break
+                raise ValueError("Invalid event at line " + str(number) + ": " + line.strip())
+            tokens.append(token)
+            position += len(token[1])
+        if not after_comment:
+            newlines = True
+            if tokens:
+                if "_NL" not in get_expected_terminals(tokens):
+                    raise ValueError("Unfinished event at line " + str(number) + ": " + line.strip())
+                event = parse_song_event(tokens, number)
+                parsed += 1
+                tokens = []
+                if event is not None:
+                    yield event
+    if tokens:
+        raise ValueError("Unfinished event at the end of the song: " + " ".join(token[1] for token in tokens))
+    if newlines and not parsed:
+        # The grammar needs an event after the first newline
+        raise ValueError("Song without events")
+
+def get_expected_terminals(tokens):
+    """Returns the terminals the grammar accepts after the tokens of an 
+    event, in the order Lark tries them. _NL means the event can end 
+    there. Comments can follow any token."""
+    if not tokens:
+        return ("NUMBER", "FILENAME", "SOUNDFONT", "PRESET", "BPM")
+    kind = tokens[0][0]
+    count = len(tokens)
+    if kind == "NUMBER":
+        if tokens[-1][0] == "NUMBER":
+            return ("NUMBER", "START")
+        after_start = count - [token[0] for token in tokens].index("START")
+        return (("NUMORSIG",), ("DURATION",), ("NUMORSIG",), ("_NL",))[after_start - 1]
+    if kind == "FILENAME":
+        return (("START",), ("NUMORSIG",), ("LOOP", "_NL"), ("NUMBER",), ("_NL",))[count - 1]
+    if kind == "SOUNDFONT":
+        return (("FILENAME",), ("_NL",))[count - 1]
+    return (("NUMBER",), ("_NL",))[count - 1]
+
+def match_song_token(line, position, expected):
+    """Returns the type and text of the token at the position, or None
+    if none of the expected terminals match there"""
+    for name in expected:
+        if name in UNBOUNDED_TERMINALS:
+            match = TERMINALS[name].match(line, position)
+            if match:
+                return name, match.group()
+    if line.startswith("//", position):
+        return None
+    for name in expected:
+        if name in TERMINALS and name not in UNBOUNDED_TERMINALS:
+            match = TERMINALS[name].match(line, position)
+            if match:
+                return name, match.group()
+    return None
+
+def parse_song_lines(lines):
+    """Parses the lines of a song without Lark. Returns the same 
+    events and options as pre_convert_song."""
+    events = []
+    song_options = {}
+    for event in iter_song_lines(lines):
+        if type(event) == dict and event["type"] in OPTION_EVENTS:
+            song_options[event["type"]] = event[OPTION_EVENTS[event["type"]]]
+        else:
+            events.append(event)
+    return events, song_options
+
+def parse_song_event(tokens, number):
+    """Returns the event made of the (type, text) tokens of one line. 
+    Calls to songs that aren't text or JSON files are ignored and 
+    return None."""
+    kind = tokens[0][0]
+    values = [token[1] for token in tokens]
+    if kind in ("PRESET", "BPM"):
+        return {"type": kind.lower(), "value": int(values[1])}
+    elif kind == "SOUNDFONT":
+        return {"type": "soundfont", "filename": values[1]}
+    elif kind == "NUMBER":
+        i = len(values) - 4
+        if i == 1:
+            keys = int(values[0])
+        elif values[i] in ("start", "s"):
+            keys = [int(value) for value in values[:i]]
+        else:
+            # The chord transformer only stops at the lowercase keyword
+            raise ValueError("Invalid chord at line " + str(number) + ": " + " ".join(values))
+        if "/" in values[i + 1] or "/" in values[i + 3]:
+            return [keys, convert_to_float(values[i + 1]), convert_to_float(values[i + 3])]
+        return [keys, int(values[i + 1]), int(values[i + 3])]
+    elif values[0].rsplit(".", 1)[1] in ("json", "txt"):
+        song = {"type": "song", "filename": values[0]}
+        if "/" in values[2]:
+            song["start"] = convert_to_float(values[2])
+        else:
+            song["start"] = int(values[2])
+        if len(values) == 5 and values[3] in ("loop", "l"):
+            song["loop"] = int(values[4])
+        return song
+    return None
+
+def parse_song(filename):
+    """Parses a song file with the line parser, or with Lark if use_lark is set"""
+    if use_lark:
+        return pre_convert_song(filename)
+    with open(filename, encoding="utf-8") as f:
+        return parse_song_lines(f)
+
 def convert_song_to_text(filename, object):
     output = ""
 
@@ -127,24 +308,199 @@ def convert_song_to_text(filename, object):
                 output += "preset " + str(item["value"]) + "\n"
             elif item["type"] == "soundfont":
                 output += "soundfont " + str(item["filename"]) + "\n"
+            elif item["type"] == "bpm":
+                output += "bpm " + str(item["value"]) + "\n"
 
     output_file = open(filename, "w")
     output_file.write(output)
     output_file.close()
 
+def convert_song_text(text):
+    """Parses the text of a song with Lark and returns its events and options"""
+    transformer = TreeTransformer()
+    transformer.transform(parser.parse(text))
+    return transformer.result, transformer.options
+
 def convert_song(filename):
-    global result, options
-    
     with open(filename, encoding="utf-8") as f:
         file_content = f.read()
         file_content = file_content + "\n"
     
-    tree = parser.parse(file_content)
-    TreeTransformer().transform(tree)
+    return convert_song_text(file_content)
 
 def pre_convert_song(filename):
-    global result, options
-    result = []
-    options = {}
-    convert_song(filename)
-    return result, options
+    return convert_song(filename)
+
+def get_song_key(filename):
+    """Returns the key used to cache a song: its path, modification time and size"""
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+def load_song(filename):
+    """Returns the events and options of a song, only parsing the file 
+    if it changed since the last time it was loaded.
+    The returned objects are shared and must not be modified."""
+    key = get_song_key(filename)
+    cached = song_cache.get(key[0])
+    if cached is not None and cached[0] == key:
+        return cached[1], cached[2]
+    loaded = read_song_sidecar(filename, key)
+    if loaded is None:
+        loaded = parse_song(filename)
+        write_song_sidecar(filename, key, loaded[0], loaded[1])
+    notes, options = loaded
+    song_cache[key[0]] = (key, notes, options)
+    return notes, options
+
+def load_songs(filenames, workers=None):
+    """Loads several songs at once in a pool of threads. Returns a 
+    dictionary with the events and options of every song, or with 
+    the exception raised while loading it."""
+    loaded = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {filename: pool.submit(load_song, filename) for filename in dict.fromkeys(filenames)}
+    for filename, future in futures.items():
+        try:
+            loaded[filename] = future.result()
+        except Exception as e:
+            loaded[filename] = e
+    return loaded
+
+def load_song_options(filename):
+    """Returns only the options of a song. When the song has an up to date 
+    sidecar only its header is read, otherwise the song is loaded."""
+    key = get_song_key(filename)
+    cached = song_cache.get(key[0])
+    if cached is not None and cached[0] == key:
+        return cached[2]
+    try:
+        with open(get_sidecar_filename(filename), "rb") as f:
+            header = read_sidecar_header(f, key)
+        if header is not None:
+            return header["options"]
+    except (OSError, ValueError):
+        pass
+    return load_song(filename)[1]
+
+def get_sidecar_filename(filename):
+    return filename + SIDECAR_EXTENSION
+
+def write_song_sidecar(filename, key, notes, options):
+    """Writes the compiled version of a song next to its text file.
+    Notes and chords are stored as numeric arrays with one row per note, 
+    every other event is kept in the JSON header along with the options."""
+    index = array("I")
+    note = array("h")
+    start = array("d")
+    duration = array("d")
+    channel = array("B")
+    velocity = array("B")
+    flags = array("B")
+    other = []
+    for i, event in enumerate(notes):
+        if type(event) != list:
+            other.append([i, event])
+            continue
+        flag = 0
+        if type(event[1]) == float or type(event[2]) == float:
+            flag |= FLAG_FLOAT
+        if len(event) > 3:
+            flag |= FLAG_EXTENDED
+        if type(event[0]) == list:
+            flag |= FLAG_CHORD
+            keys = event[0]
+        else:
+            keys = [event[0]]
+        for k in keys:
+            index.append(i)
+            note.append(k)
+            start.append(event[1])
+            duration.append(event[2])
+            channel.append(event[3] if len(event) > 3 else 0)
+            velocity.append(event[4] if len(event) > 4 else 100)
+            flags.append(flag)
+    header = {"source": list(key[1:]), "events": len(notes), "options": options, "other": other}
+    header = json.dumps(header).encode("utf-8")
+    header += b" " * (-(SIDECAR_HEADER.size + len(header)) % 8)
+    sidecar = get_sidecar_filename(filename)
+    # Each thread and process writes its own temporary file
+    temporary = sidecar + "." + str(os.getpid()) + "-" + str(threading.get_ident()) + ".tmp"
+    try:
+        with open(temporary, "wb") as f:
+            f.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION, 0, len(index), len(header)))
+            f.write(header)
+            for values in (start, duration, index, note, channel, velocity, flags):
+                values.tofile(f)
+        os.replace(temporary, sidecar)
+    except (OSError, OverflowError):
+        pass
+
+def read_sidecar_header(f, key):
+    """Reads the header of a sidecar file. Returns None if the 
+    sidecar doesn't belong to the current version of the song."""
+    magic, version, _, count, length = SIDECAR_HEADER.unpack(f.read(SIDECAR_HEADER.size))
+    if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION:
+        return None
+    header = json.loads(f.read(length).decode("utf-8"))
+    if header["source"] != list(key[1:]):
+        return None
+    header["count"] = count
+    header["offset"] = SIDECAR_HEADER.size + length
+    return header
+
+def read_song_sidecar(filename, key):
+    """Loads a song from its sidecar through a memory map, 
+    skipping the parser entirely. Returns None if there is 
+    no sidecar or if it is older than the song."""
+    try:
+        with open(get_sidecar_filename(filename), "rb") as f:
+            header = read_sidecar_header(f, key)
+            if header is None:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                columns = read_sidecar_columns(mm, header["offset"], header["count"])
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+    start, duration, index, note, channel, velocity, flags = columns
+    notes = [None] * header["events"]
+    for i, event in header["other"]:
+        notes[i] = event
+    for row in range(header["count"]):
+        i = index[row]
+        if notes[i] is not None:
+            notes[i][0].append(note[row])
+            continue
+        flag = flags[row]
+        if flag & FLAG_FLOAT:
+            event = [note[row], start[row], duration[row]]
+        else:
+            event = [note[row], int(start[row]), int(duration[row])]
+        if flag & FLAG_CHORD:
+            event[0] = [event[0]]
+        if flag & FLAG_EXTENDED:
+            event += [channel[row], velocity[row]]
+        notes[i] = event
+    return notes, header["options"]
+
+def read_sidecar_columns(mm, offset, count):
+    """Splits the mapped sidecar into its numeric columns"""
+    columns = []
+    view = memoryview(mm)
+    try:
+        for code, size in (("d", 8), ("d", 8), ("I", 4), ("h", 2), ("B", 1), ("B", 1), ("B", 1)):
+            column = view[offset:offset + count * size].cast(code)
+            columns.append(column.tolist())
+            column.release()
+            offset += count * size
+    finally:
+        view.release()
+    return columns
+
+def find_song_files(directories):
+    """Returns every .txt file inside the directories, recursively"""
+    filenames = []
+    for directory in directories:
+        for path, dirs, files in os.walk(directory):
+            dirs.sort()
+            filenames += [os.path.join(path, name) for name in sorted(files) if name.endswith(".txt")]
+    return filenames
@@ -0,0 +1,55 @@
+"""Checks the level of the cache files of audio events.
+Run with python -m unittest test_audiocache."""
+import array
+import os
+import tempfile
+import unittest
+import wave
+
+import audiocache
+
+output_format = (44100, 2, 2)
+
+def write_wav(filename, rate, channels, samples):
+    with wave.open(filename, "wb") as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(array.array("h", samples).tobytes())
+
+def get_peak(filename):
+    with wave.open(filename, "rb") as w:
+        return max(abs(sample) for sample in array.array("h", w.readframes(w.getnframes())))
+
+class CacheLevelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_directory = audiocache.cache_directory
+        audiocache.cache_directory = self.directory.name
+        self.source = os.path.join(self.directory.name, "source.wav")
+        write_wav(self.source, 22050, 1, [10000, -10000] * 2205)
+
+    def tearDown(self):
+        audiocache.cache_directory = self.cache_directory
+        self.directory.cleanup()
+
+    def build(self, start, end, volume):
+        key = audiocache.build_audio_cache(self.source, start, end, volume, output_format)[1]
+        return audiocache.get_cache_filename(key)
+
+    def test_format_conversion_keeps_level(self):
+        """A wav file cached only to change its format plays as loud as it would directly"""
+        self.assertTrue(audiocache.needs_cache(self.source, 0, 0, 0, output_format))
+        cache_filename = self.build(0, 0, 0)
+        with wave.open(cache_filename, "rb") as w:
+            self.assertEqual((w.getframerate(), w.getnchannels(), w.getsampwidth()), output_format)
+        self.assertAlmostEqual(get_peak(cache_filename), 10000, delta=100)
+
+    def test_settings_apply_volume(self):
+        """Events with settings are lowered by 20 dB before their volume is applied"""
+        self.assertAlmostEqual(get_peak(self.build(0, 0, 6)), 10000 * 10 ** (-14 / 20), delta=100)
+        self.assertAlmostEqual(get_peak(self.build(0, 0.05, 0)), 1000, delta=100)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+"""Checks the look-ahead scheduling of songs and of the metronome on
+the sequencer of the null backend, driven by a manual clock.
+Run with python -m unittest test_scheduler."""
+import unittest
+
+import backends
+import scheduler
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.seq = backends.NullSequencer(use_system_timer=False)
+        self.seq.get_tick = lambda: self.now
+        self.synth = backends.NullSynth()
+        self.dest = self.seq.register_fluidsynth(self.synth)
+
+    def advance(self, now):
+        self.now = now
+        self.seq.process(now)
+
+    def get_queued(self, client, kind):
+        return [entry for entry in self.seq.queue if entry[3] == client and entry[2][0] == kind]
+
+    def start_song(self, notes, loop=1):
+        timeline, length = scheduler.build_timeline(notes, 0)
+        return scheduler.start_stream(self.seq, self.dest, timeline, length, loop, 0, 0)
+
+    def stop_song(self, stream):
+        """Stops a stream the way the keyboard stops a song"""
+        scheduler.stop_stream(stream)
+        self.seq.remove_events(stream["client"])
+        self.seq.unregister_client(stream["client"])
+        return scheduler.get_sounding_keys(stream, self.seq.get_tick())
+
+    def test_overlapping_notes_of_one_key(self):
+        """Both notes of the key are in the first window, but only the first one sounds at 100 ms"""
+        stream = self.start_song([[60, 0, 200], [60, 300, 200]])
+        self.assertEqual(len(self.get_queued(stream["client"], "noteon")), 2)
+        self.advance(100)
+        self.assertEqual(self.stop_song(stream), [(0, 60)])
+        self.assertEqual(self.seq.queue, [])
+
+    def test_second_note_of_one_key(self):
+        stream = self.start_song([[60, 0, 200], [60, 300, 200]])
+        self.advance(350)
+        self.assertEqual(scheduler.get_sounding_keys(stream, self.now), [(0, 60)])
+        self.advance(600)
+        self.assertEqual(scheduler.get_sounding_keys(stream, self.now), [])
+
+    def test_no_events_after_stop(self):
+        """A refill timer that fires after the stream was stopped queues nothing"""
+        stream = self.start_song([[60, i * 100, 50] for i in range(20)])
+        self.advance(100)
+        self.stop_song(stream)
+        scheduler.stream_callback(stream, self.now, None, self.seq, None)
+        scheduler.fill_window(stream)
+        self.assertEqual(self.seq.queue, [])
+
+    def test_metronome_keeps_one_timer(self):
+        """Changing the tempo replaces the refill timer instead of adding one"""
+        metronome = scheduler.start_metronome_stream(self.seq, self.dest, 120, 4)
+        for bpm in (90, 140, 60, 120):
+            self.advance(self.now + 100)
+            scheduler.change_metronome_stream(metronome, bpm, 4)
+        self.assertEqual(len(self.get_queued(metronome["client"], "timer")), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+"""Checks the line parser of songparser against the Lark grammar on 
+every song in songs/ and demos/, and measures the throughput of both.
+Run with python -m unittest test_songparser, or with 
+python test_songparser.py benchmark [events] for the benchmark."""
+import os
+import sys
+import time
+import unittest
+
+import songparser
+
+directories = [os.path.join(os.path.dirname(os.path.abspath(__file__)), directory) for directory in ("songs", "demos")]
+
+def parse_with_lark(filename):
+    try:
+        return repr(songparser.pre_convert_song(filename))
+    except Exception:
+        return None
+
+def parse_lines(lines):
+    try:
+        return repr(songparser.parse_song_lines(lines))
+    except ValueError:
+        return None
+
+def parse_with_lines(filename):
+    with open(filename, encoding="utf-8") as f:
+        return parse_lines(f)
+
+class LineParserTest(unittest.TestCase):
+
+    def test_songs_match_lark(self):
+        """Songs that neither parser accepts count as agreeing"""
+        filenames = songparser.find_song_files(directories)
+        self.assertTrue(filenames)
+        for filename in filenames:
+            with self.subTest(filename=os.path.relpath(filename)):
+                self.assertEqual(parse_with_lines(filename), parse_with_lark(filename))
+
+    def test_generated_song_matches_lark(self):
+        text = generate_song(1000)
+        self.assertEqual(repr(songparser.parse_song_lines(text.splitlines(True))), repr(songparser.convert_song_text(text)))
+
+    def test_unspaced_tokens_match_lark(self):
+        """Lark splits tokens by its terminals, not by whitespace"""
+        for text in ("79 s0 d3\n", "79 start0 duration3\n", "60 64start 0 duration 3\n", "60s0d1\n",
+                     "preset0\nbpm120\n", "//x.txt s 0\n", "a.txt s 0 l 2 // comment\n\n60 s 1 d 1\n",
+                     "60 s 0 d 1\r\n61 s 1 d 1\r\n", "60.txt s 0\n", "60 s 0\n", "60 s 0 d 1 2\n"):
+            with self.subTest(text=text):
+                try:
+                    expected = repr(songparser.convert_song_text(text))
+                except Exception:
+                    expected = None
+                self.assertEqual(parse_lines(text.splitlines(True)), expected)
+
+def generate_song(events):
+    """Returns the text of a song with the given number of events,
+    mixing notes, chords, fractions and calls to other songs"""
+    lines = ["preset 0", "bpm 120"]
+    for i in range(events):
+        if i % 10 == 9:
+            lines.append("songs/test.txt start " + str(i) + " loop 2")
+        elif i % 5 == 4:
+            lines.append(str(60 + i % 12) + " " + str(64 + i % 12) + " 67 start " + str(i) + " duration 1/2")
+        else:
+            lines.append(str(48 + i % 36) + " s " + str(i) + " d " + str(1 + i % 4))
+    return "\n".join(lines) + "\n"
+
+def benchmark(events=100000):
+    """Prints the parse throughput of Lark and of the line parser"""
+    text = generate_song(events)
+    start = time.perf_counter()
+    expected = songparser.convert_song_text(text)
+    lark_time = time.perf_counter() - start
+    start = time.perf_counter()
+    parsed = songparser.parse_song_lines(text.splitlines(True))
+    line_time = time.perf_counter() - start
+    assert repr(parsed) == repr(expected)
+    print("Lark: " + str(round(events / lark_time)) + " events/s")
+    print("Line parser: " + str(round(events / line_time)) + " events/s (" + str(round(lark_time / line_time, 1)) + "x)")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark(*[int(value) for value in sys.argv[2:3]])
+    else:
+        unittest.main()